@@ -22,43 +22,119 @@ OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
 
 
-__all__ = ['flex', 'fake']
+__all__ = ['flex', 'fake', 'stub', 'template', 'context']
 
 
+import os
 import sys
-
+import warnings
+
+from flex import profiling
+from flex.context import _Context
+from flex.context import _current_context
+from flex.exceptions import FlexError
+from flex.expectation import _StubSpec
+from flex.expectation import _Template
 from flex.fake import _Fake
 from flex.helpers import _match_args
 from flex.helpers import _get_code
 from flex.wrap import _flex_objects
 from flex.wrap import _Flex
+from flex.wrap import _get_flex
 
 
-def flex(spec):
+def flex(spec, stubs=None):
     """Wraps an object in order to manipulate its methods.
 
     Examples:
         >>> flex(SomeClass).some_method.returns('stuff')
+        >>> flex(SomeClass, {'some_method': 'stuff',
+        ...                  'other_method': stub(raises=IOError)})
 
     Args:
         - spec: object (or class or module) to wrap
+        - stubs: optional dict, or iterable of pairs, of method names to
+          stub in one go, mapped to the value to return or a stub() spec,
+          or a template() of them
 
     Returns:
         _Flex object
     """
-    matches = [x for x in _flex_objects if x._Flex__object is spec]
-    if matches:
-        mock = matches[0]
-    else:
-        mock = _Flex(spec)
+    if _pytest_unhooked:
+        _warn_unhooked()
+    context = _current_context()
+    with context.lock:
+        mock = _get_flex(spec, context)
+        if stubs is not None:
+            mock._Flex__stub_all(stubs)
     return mock
 
 
+def stub(*values, **behaviour):
+    """Describes what a method stubbed through flex(spec, stubs) does.
+
+    Examples:
+        >>> flex(SomeClass, {'read': stub('a', 'b'),
+        ...                  'close': stub(raises=IOError),
+        ...                  'lines': stub(yields=['a', 'b'])})
+
+    Args:
+        - values: values returned on successive calls, like returns()
+        - raises: exception class or instance to raise, like raises()
+        - yields: iterable of values to yield, like yields()
+        - args: tuple of positional arguments the stub applies to
+        - kwargs: dict of keyword arguments the stub applies to
+
+    Returns:
+        spec to use as a value in the stubs given to flex()
+    """
+    unknown = set(behaviour) - set(['raises', 'yields', 'args', 'kwargs'])
+    if unknown:
+        raise FlexError('unknown stub() arguments: %s' %
+                        ', '.join(sorted(unknown)))
+    yields = behaviour.get('yields')
+    if yields is not None:
+        yields = tuple(yields)
+    args = None
+    if 'args' in behaviour or 'kwargs' in behaviour:
+        args = {'kargs': tuple(behaviour.get('args', ())),
+                'kwargs': dict(behaviour.get('kwargs', {}))}
+    return _StubSpec(values, behaviour.get('raises'), yields, args)
+
+
+def template(stubs):
+    """Compiles stubs once so they can be installed on many objects.
+
+    Takes the same stubs as flex(spec, stubs). Installing the returned
+    template with flex(spec, template) is cheaper than giving flex() the
+    stubs each time, since the argument matchers and return values are
+    built once and shared between all the objects it's installed on.
+
+    Examples:
+        >>> DATABASE = template({'connect': True,
+        ...                      'query': stub([], args=('SELECT 1',))})
+        >>> flex(client, DATABASE)
+
+    Args:
+        - stubs: dict, or iterable of pairs, of method names to the value to
+          return or a stub() spec
+
+    Returns:
+        template to give to flex() in place of the stubs
+    """
+    return _Template(stubs)
+
+
 def fake(**kwargs):
     """Creates a fake object.
 
     Populates the returned object's attribute/value pairs based on
     keyword arguments provided.
+
+    Every attribute access and call on the fake is recorded in its __calls__
+    attribute. Pass __history__ to limit what is kept: an int N keeps only
+    the last N entries, 'counts' only counts accesses per attribute name in
+    __counts__, and 'off' disables recording entirely.
     """
     return _Fake(**kwargs)
 
@@ -71,40 +147,154 @@ def verify():
     Consider opening a bug or feature request AttributeError
     http://github.com/has207/flex/issues
     """
-    saved = {}
-    for mock_object, expectations in _flex_objects.items():
-        saved[mock_object] = expectations[:]
-        for expectation in expectations:
-            expectation._reset()
-    for mock_object in saved:
-        del _flex_objects[mock_object]
-    # make sure this is done last to keep exceptions here from breaking
-    # any of the previous steps that cleanup all the changes
-    for mock_object, expectations in saved.items():
-        for expectation in expectations:
-            expectation._verify()
+    profiler = profiling._profiler
+    if profiler is None:
+        _current_context().verify()
+        return
+    started = profiling._timer()
+    try:
+        _current_context().verify()
+    finally:
+        profiler.record_teardown(profiling._timer() - started)
+
+
+def context():
+    """Creates an isolated registry for flex expectations.
+
+    While the context is entered flex() and verify() only see expectations
+    created inside it, in the current thread or asyncio task and any tasks
+    started from it. Leaving the context verifies it, unless the block
+    raised, in which case stubs are removed without verification.
+
+    Examples:
+        >>> with context():
+        ...     flex(SomeClass).some_method.returns('stuff')
+
+    Returns:
+        _Context object
+    """
+    return _Context()
+
+
+# setting FLEX_PROFILE to table or json profiles the whole session, writing
+# the report to FLEX_PROFILE_OUTPUT (or stderr) when the process exits
+if os.environ.get('FLEX_PROFILE'):
+    profiling.enable(os.environ['FLEX_PROFILE'],
+                     os.environ.get('FLEX_PROFILE_OUTPUT'))
+
+# setting FLEX_LEAK_REPORT lists the objects flex still holds on to when the
+# process exits, writing to FLEX_LEAK_REPORT_OUTPUT (or stderr)
+if os.environ.get('FLEX_LEAK_REPORT'):
+    from flex import leaks
+    leaks.report_at_exit(os.environ.get('FLEX_LEAK_REPORT_OUTPUT'))
 
 
 # RUNNER INTEGRATION
+#
+# Hooks are only installed once the framework they patch gets imported so
+# that importing flex doesn't pay for importing every supported runner.
+
+
+# Maps module names to the hooks waiting for that module to be imported
+_pending_hooks = {}
+
+
+class _HookedLoader(object):
+    """Wraps a module loader to run runner hooks after the module executes."""
+
+    def __init__(self, loader, name):
+        self._loader = loader
+        self._name = name
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._loader.exec_module(module)
+        _run_hooks(self._name)
+
+
+class _RunnerHookFinder(object):
+    """Meta path finder that notices imports of supported test runners."""
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in _pending_hooks:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader,
+                                                       'exec_module'):
+                    spec.loader = _HookedLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+_hook_finder = _RunnerHookFinder()
+
+
+def _run_hooks(name):
+    for hook in _pending_hooks.pop(name, []):
+        try:
+            hook()
+        except Exception:  # never break the runner that is being imported
+            pass
+    if not _pending_hooks and _hook_finder in sys.meta_path:
+        sys.meta_path.remove(_hook_finder)
+
+
+def _when_imported(name, hook):
+    """Runs hook once the named module is imported, or now if it already is."""
+    if name in sys.modules or sys.version_info < (3, 4):
+        _pending_hooks.setdefault(name, []).append(hook)
+        _run_hooks(name)
+        return
+    _pending_hooks.setdefault(name, []).append(hook)
+    if _hook_finder not in sys.meta_path:
+        sys.meta_path.insert(0, _hook_finder)
+
+
+# set when pytest is running but expectations can't be verified after each
+# test without flex.pytest_plugin
+_pytest_unhooked = False
+
+
+def _warn_unhooked():
+    global _pytest_unhooked
+    _pytest_unhooked = False
+    if 'flex.pytest_plugin' not in sys.modules:
+        warnings.warn(
+                "flex can't verify expectations after each test with this "
+                "version of pytest, enable it with -p flex.pytest_plugin "
+                "or call flex.verify() in teardown", stacklevel=3)
 
 
 def _hook_into_pytest():
+    global _pytest_unhooked
     try:
         from _pytest import runner
-        saved = runner.call_runtest_hook
-        def call_runtest_hook(item, when):
-            ret = saved(item, when)
-            teardown = runner.CallInfo(verify, when=when)
-            if when == 'call' and not ret.excinfo:
-                teardown.result = None
-                return teardown
-            else:
-                return ret
-        runner.call_runtest_hook = call_runtest_hook
-
     except ImportError:
-        pass
-_hook_into_pytest()
+        return
+    if not hasattr(runner, 'call_runtest_hook'):
+        # newer versions only support doing this through a plugin
+        _pytest_unhooked = True
+        return
+    saved = runner.call_runtest_hook
+    def call_runtest_hook(item, when):
+        ret = saved(item, when)
+        teardown = runner.CallInfo(verify, when=when)
+        if when == 'call' and not ret.excinfo:
+            teardown.result = None
+            return teardown
+        else:
+            return ret
+    runner.call_runtest_hook = call_runtest_hook
+_when_imported('_pytest.runner', _hook_into_pytest)
 
 
 def _hook_into_doctest():
@@ -119,7 +309,7 @@ def _hook_into_doctest():
         DocTestRunner.run = run
     except ImportError:
         pass
-_hook_into_doctest()
+_when_imported('doctest', _hook_into_doctest)
 
 
 def _patch_test_result(klass):
@@ -183,20 +373,26 @@ def _hook_into_unittest():
             _patch_test_result(unittest._TextTestResult)
     except: # let's not take any chances
         pass
-_hook_into_unittest()
+_when_imported('unittest', _hook_into_unittest)
 
 
 def _hook_into_unittest2():
     try:
-        try:
-            from unittest2 import TextTestResult
-        except ImportError:
-            # Django has its own copy of unittest2 it uses as fallback
-            from django.utils.unittest import TextTestResult
+        from unittest2 import TextTestResult
+        _patch_test_result(TextTestResult)
+    except:
+        pass
+_when_imported('unittest2', _hook_into_unittest2)
+
+
+def _hook_into_django_unittest():
+    # Django has its own copy of unittest2 it uses as fallback
+    try:
+        from django.utils.unittest import TextTestResult
         _patch_test_result(TextTestResult)
     except:
         pass
-_hook_into_unittest2()
+_when_imported('django.utils.unittest', _hook_into_django_unittest)
 
 
 def _hook_into_twisted():
@@ -208,7 +404,7 @@ def _hook_into_twisted():
         _patch_test_result(reporter.TreeReporter)
     except:
         pass
-_hook_into_twisted()
+_when_imported('twisted.trial.reporter', _hook_into_twisted)
 
 
 def _hook_into_subunit():
@@ -217,7 +413,7 @@ def _hook_into_subunit():
         _patch_test_result(subunit.TestProtocolClient)
     except:
         pass
-_hook_into_subunit()
+_when_imported('subunit', _hook_into_subunit)
 
 
 def _hook_into_zope():
@@ -226,7 +422,7 @@ def _hook_into_zope():
         _patch_test_result(testrunner.runner.TestResult)
     except:
         pass
-_hook_into_zope()
+_when_imported('zope.testrunner.runner', _hook_into_zope)
 
 
 def _hook_into_testtools():
@@ -235,4 +431,4 @@ def _hook_into_testtools():
         _patch_test_result(testresult.TestResult)
     except:
         pass
-_hook_into_testtools()
+_when_imported('testtools.testresult', _hook_into_testtools)
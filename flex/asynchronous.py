@@ -0,0 +1,54 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+
+# Only imported once a coroutine or async generator function gets stubbed,
+# keeping the rest of flex importable where async syntax isn't available.
+
+import asyncio
+
+
+async def _returns(value, latency=None):
+    if latency:
+        await asyncio.sleep(latency)
+    return value
+
+
+async def _raises(exception, latency=None):
+    __tracebackhide__ = True
+    if latency:
+        await asyncio.sleep(latency)
+    raise exception
+
+
+async def _yields(values, latency=None, exception=None):
+    __tracebackhide__ = True
+    for value in values:
+        if latency:
+            await asyncio.sleep(latency)
+        yield value
+    if exception is not None:
+        if latency:
+            await asyncio.sleep(latency)
+        raise exception
@@ -0,0 +1,349 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import types
+
+from flex.exceptions import FlexError
+
+
+MAGIC = b'FLEXCAS2'
+# key length, payload length
+_HEADER = struct.Struct('>HI')
+
+RETURNED = 'returned'
+RAISED = 'raised'
+
+# Cassette objects by absolute path, so expectations recording into the same
+# file append to it through a single object
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def _call_key(method, kargs, kwargs):
+    """Builds the index key of a call from its method name and arguments.
+
+    The arguments are encoded canonically and hashed, so keys are small,
+    equal for equal arguments and stable across processes.
+
+    Raises:
+        FlexError if an argument can't be encoded
+    """
+    parts = []
+    try:
+        _encode((kargs, kwargs), parts, set())
+    except (FlexError, RuntimeError) as e:  # includes RecursionError
+        raise FlexError('%s can\'t be recorded, its arguments %r have no '
+                        'stable key: %s' % (method, (kargs, kwargs), e))
+    data = ''.join(parts).encode('utf-8')
+    return method.encode('utf-8') + b'\0' + hashlib.sha1(data).digest()
+
+
+def _encode(value, parts, active):
+    """Appends an encoding of value to parts, equal for equal values.
+
+    Dict items and set elements are sorted by their encoding, and objects
+    other than builtin values are encoded by what they pickle as, so
+    neither hash randomization nor object identity changes the result.
+    """
+    value_type = type(value)
+    if value is None or value_type is bool:
+        parts.append('%r;' % value)
+    elif value_type in (int, float, complex):
+        parts.append('%s%r;' % (value_type.__name__[0], value))
+    elif value_type is str:
+        parts.append('s%d:%s' % (len(value), value))
+    elif value_type is bytes:
+        parts.append('b%d:%s' % (len(value), value.hex()))
+    elif isinstance(value, (type, types.FunctionType,
+                            types.BuiltinFunctionType)):
+        name = '%s.%s' % (getattr(value, '__module__', None),
+                          getattr(value, '__qualname__', value.__name__))
+        parts.append('g%d:%s' % (len(name), name))
+    else:
+        if id(value) in active:
+            raise FlexError('%r contains itself' % (value,))
+        active.add(id(value))
+        if value_type in (tuple, list):
+            parts.append('%s%d(' % (value_type.__name__[0], len(value)))
+            for item in value:
+                _encode(item, parts, active)
+        elif value_type is dict:
+            parts.append('d%d(' % len(value))
+            parts.extend(sorted(_encoded(key) + _encoded(item)
+                                for key, item in value.items()))
+        elif value_type in (set, frozenset):
+            parts.append('%s%d(' % (value_type.__name__[0], len(value)))
+            parts.extend(sorted(_encoded(item) for item in value))
+        else:
+            try:
+                reduced = value.__reduce_ex__(2)
+            except Exception as e:
+                raise FlexError('%r can\'t be pickled: %s' % (value, e))
+            if isinstance(reduced, str):  # pickled by reference
+                reduced = (value_type, reduced)
+            parts.append('o(')
+            for item in reduced:
+                if isinstance(item, types.GeneratorType) or (
+                        hasattr(item, '__next__') and iter(item) is item):
+                    item = list(item)  # list or dict items
+                _encode(item, parts, active)
+        parts.append(')')
+        active.discard(id(value))
+
+
+def _encoded(value):
+    parts = []
+    _encode(value, parts, set())
+    return ''.join(parts)
+
+
+class Cassette(object):
+    """Recorded outcomes of calls to real methods, kept in a file.
+
+    The file starts with MAGIC followed by records, each made of a header
+    with the key and payload lengths, the key (method name, a NUL byte and
+    the SHA-1 of the arguments) and the payload, a pickled (kind, value)
+    tuple where kind is RETURNED or RAISED, exceptions being kept as their
+    type, args and attributes. Records are appended as soon as a call is
+    recorded.
+
+    The file is memory-mapped and only the headers are read when it is
+    opened, building an index of record offsets by key. Payloads are
+    unpickled when a call replays them, so tests touching a handful of
+    calls don't pay for decoding the whole cassette, and every replay gets
+    its own copy of the value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # key -> list of (offset, length) of payloads in recorded order
+        self._index = {}
+        # keys first recorded by this process, which keep calling the real
+        # method once their outcomes run out instead of repeating the last
+        self._recording = set()
+        self._map = None
+        self._size = 0
+        if os.path.exists(path):
+            self._load()
+
+    def _current(self):
+        """Whether the file is still the one this cassette has indexed."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:  # deleted, to be recorded again
+            size = 0
+        return size == self._size
+
+    def _reset(self):
+        """Forgets what was indexed, once the file was deleted or replaced."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._index = {}
+        self._recording = set()
+        self._size = 0
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        f = open(self.path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                self._map = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return size
+
+    def _load(self):
+        size = self._remap()
+        data = self._map
+        if data is None:
+            return
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a flex cassette' % self.path)
+        offset = len(MAGIC)
+        while offset + _HEADER.size <= size:
+            key_length, length = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size + key_length
+            if start + length > size:  # interrupted while recording
+                break
+            key = data[offset + _HEADER.size:start]
+            self._index.setdefault(key, []).append((start, length))
+            offset = start + length
+        self._size = offset
+
+    def outcome(self, key, index):
+        """Returns the index-th (kind, value) outcome recorded for key.
+
+        Returns None when the call has to be made for real and recorded.
+        """
+        outcomes = self._index.get(key)
+        if not outcomes:
+            return None
+        if index < len(outcomes):
+            start, length = outcomes[index]
+        elif key in self._recording:
+            return None
+        else:
+            start, length = outcomes[-1]
+        if self._map is None or start + length > len(self._map):
+            self._remap()
+        return pickle.loads(self._map[start:start + length])
+
+    def record(self, key, kind, value):
+        """Appends the outcome of a call to the cassette.
+
+        Args:
+            - key: key of the call, from _call_key()
+            - kind: RETURNED or RAISED
+            - value: value returned, or _RaisedError of the exception raised
+        """
+        self._append(key, pickle.dumps((kind, value), 2))
+
+    def _append(self, key, payload):
+        f = open(self.path, 'ab')
+        try:
+            size = f.tell()
+            if size < self._size:  # deleted or replaced since it was loaded
+                self._reset()
+                if size:
+                    self._load()
+            if size != self._size:  # drop a record cut off mid-write
+                f.truncate(self._size)
+            if not self._size:
+                f.write(MAGIC)
+                self._size = len(MAGIC)
+            f.write(_HEADER.pack(len(key), len(payload)) + key + payload)
+        finally:
+            f.close()
+        start = self._size + _HEADER.size + len(key)
+        self._size = start + len(payload)
+        if key not in self._index:
+            self._recording.add(key)
+        self._index.setdefault(key, []).append((start, len(payload)))
+
+
+class _Recording(object):
+    """Plays calls of a single expectation against a cassette.
+
+    Calls with the same arguments replay their recorded outcomes in order,
+    repeating the last one. Calls missing from the cassette run the real
+    method and get recorded, including exceptions they raise.
+    """
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self._played = {}
+
+    def play(self, method, kargs, kwargs, call):
+        """Replays the outcome of a call, or records it by running call.
+
+        Args:
+            - method: name of the method being called
+            - kargs, kwargs: arguments of the call
+            - call: callable running the real method
+        """
+        cassette = self.cassette
+        key = _call_key(method, kargs, kwargs)
+        with cassette.lock:
+            played = self._played.get(key, 0)
+            self._played[key] = played + 1
+            outcome = cassette.outcome(key, played)
+        if outcome is not None:
+            kind, value = outcome
+            if kind == RAISED:
+                if isinstance(value, _RaisedError):
+                    value = value.rebuild()
+                raise value
+            return value
+        try:
+            value = call()
+        except Exception:
+            error = sys.exc_info()[1]
+            payload = _dumps(method, RAISED, _RaisedError(error), 'raised')
+            with cassette.lock:
+                cassette._append(key, payload)
+            raise
+        payload = _dumps(method, RETURNED, value, 'returned')
+        with cassette.lock:
+            cassette._append(key, payload)
+        return value
+
+
+def _dumps(method, kind, value, outcome):
+    try:
+        return pickle.dumps((kind, value), 2)
+    except Exception as e:
+        if isinstance(value, _RaisedError):
+            value = value.error
+        raise FlexError('%s %s %r, which can\'t be recorded: %s' %
+                        (method, outcome, value, e))
+
+
+class _RaisedError(object):
+    """Exception recorded without its __init__, which pickle would call.
+
+    An __init__ taking different arguments than those it passes on to
+    Exception would fail, or build another message, when unpickled.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+    def __getstate__(self):
+        error = self.error
+        return (type(error), error.args, getattr(error, '__dict__', None))
+
+    def __setstate__(self, state):
+        self.error = None
+        self.state = state
+
+    def rebuild(self):
+        error_type, args, attributes = self.state
+        error = error_type.__new__(error_type, *args)
+        error.args = args
+        if attributes:
+            error.__dict__.update(attributes)
+        return error
+
+
+def _get_cassette(path):
+    path = os.path.abspath(path)
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is None or not cassette._current():
+            cassette = _cassettes[path] = Cassette(path)
+        return cassette
@@ -0,0 +1,214 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+import threading
+import weakref
+
+from flex.helpers import _restore_method
+
+try:
+    import contextvars
+except ImportError:  # contextvars is only available since 3.7
+    contextvars = None
+
+
+# every live context, for the leak report
+_contexts = weakref.WeakSet()
+
+
+class _Registry(object):
+    """Maps each _Flex to its expectations without keeping it alive.
+
+    The expectations are stored on the _Flex itself, and the _Flex is only
+    referenced by the stubs it installs on the flexed object. An object
+    nothing else references anymore is collected along with its _Flex and
+    expectations, and drops out of the registry.
+    """
+
+    def __init__(self):
+        self._mocks = weakref.WeakSet()
+
+    def __contains__(self, mock):
+        return mock in self._mocks
+
+    def __getitem__(self, mock):
+        if mock not in self._mocks:
+            raise KeyError(mock)
+        return mock._Flex__expectations
+
+    def __setitem__(self, mock, expectations):
+        mock._Flex__expectations = expectations
+        self._mocks.add(mock)
+
+    def __iter__(self):
+        return iter(list(self._mocks))
+
+    def __len__(self):
+        return len(self._mocks)
+
+    def get(self, mock, default=None):
+        if mock not in self._mocks:
+            return default
+        return mock._Flex__expectations
+
+    def keys(self):
+        return list(self._mocks)
+
+    def values(self):
+        return [mock._Flex__expectations for mock in list(self._mocks)]
+
+    def items(self):
+        return [(mock, mock._Flex__expectations) for mock in list(self._mocks)]
+
+    def clear(self):
+        for mock in list(self._mocks):
+            mock._Flex__expectations = None
+            mock._Flex__respecialize()
+        self._mocks.clear()
+
+
+class _Context(object):
+    """Registry of flexed objects and their expectations.
+
+    flex() and verify() work against the current context, which is a single
+    global one unless another context has been entered. Entering a context
+    makes it current for the running thread or asyncio task (and tasks it
+    creates), so tests running concurrently in one process each get their
+    own expectations and teardown.
+
+    Contexts only isolate bookkeeping: two contexts stubbing the same class
+    or module at the same time will still replace each other's methods.
+    """
+
+    def __init__(self):
+        # _Flex -> list of Expectation objects, each _Flex also keeps the
+        # original of every method it replaced so it's restored only once
+        self.objects = _Registry()
+        # id() of flexed objects -> _Flex, an entry goes away with its _Flex
+        # which references the object, so the id can't be reused before
+        self.ids = weakref.WeakValueDictionary()
+        # expectations with times() or ordered(), the only ones that can fail
+        # verification, mapped to their _Flex to keep the flexed object alive
+        # until verified
+        self.verifiable = {}
+        # ordered() expectations in declaration order, and the position of
+        # the first one that hasn't been called yet
+        self.ordered = []
+        self.order_cursor = 0
+        # flex.transport exports whose worker processes report calls back
+        self.transports = []
+        # flex.transport.share() counters that new expectations get a slot in
+        self.counters = None
+        # guards the registries above, stubbed methods only take the lock
+        # of the expectation they matched
+        self.lock = threading.RLock()
+        self._tokens = []
+        _contexts.add(self)
+
+    def __enter__(self):
+        self._tokens.append(_enter(self))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _exit(self._tokens.pop())
+        if type is None:
+            self.verify()
+        else:
+            # keep the original failure, but still undo all the stubbing
+            self._teardown()
+
+    def verify(self):
+        """Restores stubbed methods and verifies expectations of this context.
+
+        Raises:
+            MethodCallError if any expectation wasn't met
+        """
+        with self.lock:
+            transports = list(self.transports)
+        for transport in transports:
+            transport.collect()
+        verifiable = self._teardown()
+        # make sure this is done last to keep exceptions here from breaking
+        # any of the previous steps that cleanup all the changes
+        for expectation in verifiable:
+            expectation._verify()
+
+    def _teardown(self):
+        with self.lock:
+            patched = self._patched()
+            verifiable = list(self.verifiable)
+            self.objects.clear()
+            self.ids.clear()
+            self.verifiable.clear()
+            del self.ordered[:]
+            self.order_cursor = 0
+            del self.transports[:]
+            self.counters = None
+        self._restore(patched)
+        return verifiable
+
+    def _patched(self):
+        """Returns (object, method name, original) for each replaced method."""
+        return [(mock._Flex__object, method, original)
+                for mock in self.objects
+                for method, original in mock._Flex__patched.items()]
+
+    def _restore(self, patched=None):
+        """Puts back every method replaced in this context."""
+        if patched is None:
+            with self.lock:
+                patched = self._patched()
+        for obj, method, original_method in patched:
+            if original_method:
+                _restore_method(obj, method, original_method)
+
+
+_global_context = _Context()
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('flex_context', default=_global_context)
+
+    def _current_context():
+        return _current.get()
+
+    def _enter(context):
+        return _current.set(context)
+
+    def _exit(token):
+        _current.reset(token)
+
+else:
+    _local = threading.local()
+
+    def _current_context():
+        return getattr(_local, 'context', _global_context)
+
+    def _enter(context):
+        token = _current_context()
+        _local.context = context
+        return token
+
+    def _exit(token):
+        _local.context = token
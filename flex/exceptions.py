@@ -22,8 +22,58 @@ OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
 
 
+class _Message(object):
+    """Error message that is only formatted once it's displayed.
+
+    Stubs raise errors that the code under test may catch and discard,
+    retry loops in particular, so describing the arguments involved is
+    left until someone actually looks at the message.
+    """
+
+    __slots__ = ('format', 'args', 'text')
+
+    def __init__(self, format, *args):
+        self.format = format
+        self.args = args
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            self.text = self.format(*self.args)
+            self.format = self.args = None
+        return self.text
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __reduce__(self):
+        # the arguments might not pickle, the text will
+        return str, (str(self),)
+
+
 class FlexError(Exception):
-    pass
+
+    # a _Message given as the message is only rendered when args is read,
+    # str() and pickling go through the stored args and render it themselves
+    @property
+    def args(self):
+        args = Exception.args.__get__(self)
+        if args and type(args[0]) is _Message:
+            return (str(args[0]),) + args[1:]
+        return args
+
+    @args.setter
+    def args(self, args):
+        Exception.args.__set__(self, args)
 
 
 class MockBuiltinError(FlexError):
@@ -52,3 +102,7 @@ class MethodCallError(FlexError):
 
 class CallOrderError(FlexError):
     pass
+
+
+class ExhaustedError(FlexError):
+    pass
@@ -22,25 +22,74 @@ OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
 
 
+import threading
+
 from flex.exceptions import CallOrderError
+from flex.exceptions import ExhaustedError
 from flex.exceptions import FlexError
 from flex.exceptions import MethodCallError
+from flex.exceptions import _Message
+from flex.helpers import _ArgsMatcher
 from flex.helpers import _arg_to_str
 from flex.helpers import _format_args
 from flex.helpers import _isclass
-from flex.helpers import _match_args
+from flex.helpers import _restore_method
 
 
 AT_LEAST = 'at least'
 AT_MOST = 'at most'
 EXACTLY = 'exactly'
 
+# what to do once every return value has been handed out
+CYCLE = 'cycle'
+RAISE = 'raise'
+REPEAT_LAST = 'repeat last'
+
+
+def _format_call_count(method, args, expected_calls, final, called):
+    if expected_calls[EXACTLY] is not None:
+        message = 'exactly %s' % expected_calls[EXACTLY]
+    else:
+        message = ''
+        if final and expected_calls[AT_LEAST] is not None:
+            message = 'at least %s' % expected_calls[AT_LEAST]
+        if expected_calls[AT_MOST] is not None:
+            if message:
+                message += ' and '
+            message += 'at most %s' % expected_calls[AT_MOST]
+    return ('%s expected to be called %s times, called %s times' %
+            (_format_args(method, args), message, called))
+
+
+def _format_call_order(method, args, expected_method, expected_args):
+    return '%s called before %s' % (_format_args(method, args),
+                                    _format_args(expected_method, expected_args))
+
+
+def _always_runnable():
+    return True
+
 
 class ReturnValue(object):
     def __init__(self, value=None, raises=None):
         self.value = value
         self.raises = raises
 
+    def exception(self):
+        """Returns the exception to raise for a value given by raises().
+
+        Classes and factories are called with the arguments given to
+        raises(). Instances are raised again every time, with the
+        traceback of the previous raise cleared so it doesn't keep growing.
+        """
+        raises = self.raises
+        if isinstance(raises, BaseException):
+            raises.__traceback__ = None
+            return raises
+        if callable(raises):
+            return raises(*self.value['kargs'], **self.value['kwargs'])
+        return raises
+
     def __str__(self):
         if self.raises:
             return '%s(%s)' % (self.raises, _arg_to_str(self.value))
@@ -48,6 +97,190 @@ class ReturnValue(object):
             return _arg_to_str(self.value)
 
 
+class ReturnValues(object):
+    """Sequence of return values handed out in order by a moving cursor.
+
+    Advancing costs the same regardless of how many values were scripted.
+    What happens after the last value depends on the exhaust mode: CYCLE
+    starts over from the first one, REPEAT_LAST keeps returning the last
+    one and RAISE raises ExhaustedError.
+    """
+
+    def __init__(self):
+        self._values = []
+        self._cursor = 0
+        self.exhaust = CYCLE
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def append(self, value):
+        cursor = self._cursor
+        if cursor and self.exhaust == CYCLE:
+            # values used to be rotated on every call, so the next one has to
+            # come first for the added one to fit in the same cycle
+            values = self._values
+            self._values = list(values[cursor:]) + list(values[:cursor])
+            self._cursor = 0
+        elif type(self._values) is tuple:
+            # values shared with a template, copy before changing them
+            self._values = list(self._values)
+        self._values.append(value)
+
+    def _share(self, values):
+        """Hands out values, a tuple that may be shared between stubs."""
+        self._values = values
+        self._cursor = 0
+
+    def advance(self):
+        """Returns the next value and moves the cursor past it."""
+        values = self._values
+        cursor = self._cursor
+        if cursor >= len(values):
+            if self.exhaust == REPEAT_LAST:
+                return values[-1]
+            elif self.exhaust == RAISE:
+                raise ExhaustedError(
+                    'all %s return values have been used' % len(values))
+            cursor = 0
+        self._cursor = cursor + 1
+        return values[cursor]
+
+
+# Expectation attributes tied to the process that created it
+_PROCESS_STATE = (
+    'original_method', 'original_function', '_matcher', '_normalize',
+    '_lock', '_recording', '_stats', '_transport', '_async')
+
+
+class _StubSpec(object):
+    """Behaviour of a method stubbed through flex(spec, stubs), see stub()."""
+
+    __slots__ = ('values', 'raises', 'yields', 'args')
+
+    def __init__(self, values, raises=None, yields=None, args=None):
+        self.values = values
+        self.raises = raises
+        self.yields = yields
+        self.args = args
+
+
+class _Template(object):
+    """Stubs compiled once by template(), installed by flex(spec, template).
+
+    Everything that doesn't depend on the flexed object is worked out here,
+    so installing the same template for every test only creates the
+    expectations. Argument matchers and return values are shared by all
+    of them.
+    """
+
+    __slots__ = ('entries',)
+
+    def __init__(self, stubs):
+        if hasattr(stubs, 'items'):
+            stubs = stubs.items()
+        self.entries = tuple([_TemplateEntry(method, behaviour)
+                              for method, behaviour in stubs])
+
+
+class _TemplateEntry(object):
+
+    __slots__ = ('method', 'args', 'matchers', 'return_values', 'yield_values')
+
+    def __init__(self, method, behaviour):
+        if not isinstance(behaviour, _StubSpec):
+            behaviour = _StubSpec((behaviour,))
+        self.method = method
+        self.args = behaviour.args
+        # normalizer -> _ArgsMatcher, as the canonical form of the arguments
+        # depends on the signature of the method they're given to
+        self.matchers = {}
+        values = [ReturnValue(value) for value in behaviour.values]
+        if behaviour.raises is not None:
+            values.append(ReturnValue(
+                    raises=behaviour.raises, value={'kargs': (), 'kwargs': {}}))
+        self.return_values = tuple(values)
+        self.yield_values = tuple(
+                [ReturnValue(value) for value in behaviour.yields or ()])
+
+    def instantiate(self, expectation):
+        """Gives expectation this entry's arguments and actions."""
+        if self.args is not None:
+            expectation.args = self.args
+            normalize = expectation._normalize
+            matcher = self.matchers.get(normalize)
+            if matcher is None:
+                matcher = _ArgsMatcher(expectation._normalized_args())
+                self.matchers[normalize] = matcher
+            expectation._matcher = matcher
+        if self.return_values:
+            expectation._action['return_values']._share(self.return_values)
+        if self.yield_values:
+            expectation._action['yield_values'] = list(self.yield_values)
+        return expectation
+
+
+class _YieldSource(object):
+    """Values given to yields_from(), produced as they're consumed."""
+
+    def __init__(self, source, shared):
+        self.source = source
+        self.shared = shared
+        self._iterator = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a shared cursor only advances within one process, a process it's
+        # sent to starts over from the source
+        state = dict(self.__dict__)
+        state['_iterator'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        if not self.shared:
+            return self._start()
+        with self._lock:
+            if self._iterator is None:
+                self._iterator = self._start()
+        return self._take()
+
+    def _start(self):
+        source = self.source
+        if callable(source):
+            return iter(source())
+        return iter(source)
+
+    def _take(self):
+        # calls share the iterator, make sure only one advances it at a time
+        iterator = self._iterator
+        lock = self._lock
+        while True:
+            with lock:
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+            yield value
+
+
+def _yielded(yield_values):
+    """Iterates over the values a stub yields, given by either yields method."""
+    if isinstance(yield_values, _YieldSource):
+        return iter(yield_values)
+    return (value.value for value in yield_values)
+
+
 class Expectation(object):
     """Holds expectations about methods.
 
@@ -61,9 +294,11 @@ class Expectation(object):
         self.method = name
         self.original_method = original_method
         self.args = None
+        self._matcher = None
+        self._normalize = None
         value = ReturnValue(return_value)
         self._action = {
-            'return_values': [],
+            'return_values': ReturnValues(),
             'yield_values': []
         }
         return_values = self._action['return_values']
@@ -71,10 +306,17 @@ class Expectation(object):
             return_values.append(value)
         self._replace_with = None
         self._times_called = 0
+        self._lock = threading.Lock()
         self._expected_calls = {EXACTLY: None, AT_LEAST: None, AT_MOST: None}
-        self._runnable = lambda: True
+        self._runnable = _always_runnable
         self._pass_thru = False
+        self._recording = None
+        self._stats = None
+        self._transport = None
+        self._async = None
+        self._latency = None
         self._ordered = False
+        self._order = None
         self._verified = False
 
     def __str__(self):
@@ -87,8 +329,52 @@ class Expectation(object):
             self.__raise(FlexError, 'Arguments can only be specified once')
 
         self.args = {'kargs': kargs, 'kwargs': kwargs}
+        self._matcher = _ArgsMatcher(self._normalized_args())
+        if self.method is not None:
+            self.mock._Flex__index(self)
         return self
 
+    def __getstate__(self):
+        """Leaves out what only makes sense in this process when pickled.
+
+        The stubbed method, compiled matcher, lock and recording are set up
+        again by flex.transport.install() in the process it's unpickled in,
+        and call counts start over there.
+        """
+        state = dict(self.__dict__)
+        for name in _PROCESS_STATE:
+            state.pop(name, None)
+        if state['_pass_thru']:
+            state['_replace_with'] = None
+        state['_times_called'] = 0
+        state['_verified'] = False
+        # the call order is kept by this process's context
+        state['_order'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.original_method = None
+        self._matcher = None
+        self._normalize = None
+        self._lock = threading.Lock()
+        self._recording = None
+        self._stats = None
+        self._transport = None
+        self._async = None
+
+    def _changed(self):
+        """Makes the stub reconsider how it handles calls to this method."""
+        if self.method is not None:
+            self.mock._Flex__respecialize(self.method)
+
+    def _adopt(self):
+        """Rebuilds the state left out by pickling, once installed."""
+        if self.args is not None:
+            self._matcher = _ArgsMatcher(self._normalized_args())
+        if self._pass_thru:
+            self._replace_with = self.original_method
+
     def __getattr__(self, name):
         self.__raise(
             AttributeError, "'%s' object has not attribute '%s'" %
@@ -105,6 +391,9 @@ class Expectation(object):
         returning a value and raising and exception on different method
         invocations.
 
+        When stubbing a coroutine function the value is returned once the
+        call is awaited.
+
         Args:
             - values: optional list of return values, defaults to None
 
@@ -120,13 +409,39 @@ class Expectation(object):
             return_values.append(ReturnValue())
         for value in values:
             return_values.append(ReturnValue(value))
+        self._changed()
+        return self
+
+    def when_exhausted(self, mode):
+        """Sets what happens once all values given to returns() are used.
+
+        Args:
+            - mode: CYCLE to start over from the first value (the default),
+              REPEAT_LAST to keep returning the last value, or RAISE to
+              raise ExhaustedError
+
+        Returns:
+            - self, i.e. can be chained with other Expectation methods
+        """
+        if mode not in (CYCLE, RAISE, REPEAT_LAST):
+            self.__raise(FlexError, 'unknown exhaust mode %s' % mode)
+        self._action['return_values'].exhaust = mode
+        self._changed()
         return self
 
     def raises(self, exception, *kargs, **kwargs):
         """Specifies the exception to be raised when this expectation is met.
 
+        For coroutine functions the exception is raised when the call is
+        awaited, and for async generators when it is iterated.
+
+        An instance is raised as is on every call, which is cheaper than
+        creating a new exception each time when raising many of them. A
+        factory function is called on every call instead, e.g. to raise
+        exceptions carrying different attributes.
+
         Args:
-            - exception: class or instance of the exception
+            - exception: class, instance or factory of the exception
             - kargs: optional keyword arguments to pass to the exception
             - kwargs: optional named arguments to pass to the exception
 
@@ -140,12 +455,14 @@ class Expectation(object):
         args = {'kargs': kargs, 'kwargs': kwargs}
         return_values = self._action['return_values']
         return_values.append(ReturnValue(raises=exception, value=args))
+        self._changed()
         return self
 
     def yields(self, *values):
         """Turns the return value into a generator.
 
         Each value provided is yielded on successive calls to next().
+        Coroutine and async generator functions get an async iterator.
 
         Returns:
             - self, i.e. can be chained with other Expectation methods
@@ -154,8 +471,43 @@ class Expectation(object):
         if replace_with:
             self.__raise(FlexError, 'yields() cannot be specified after runs()')
         yield_values = self._action['yield_values']
+        if isinstance(yield_values, _YieldSource):
+            self.__raise(
+                FlexError, 'yields() cannot be mixed with yields_from()')
         for value in values:
             yield_values.append(ReturnValue(value))
+        self._changed()
+        return self
+
+    def yields_from(self, source, shared=False):
+        """Turns the return value into a generator over source.
+
+        Unlike yields() the values aren't stored, they are taken from
+        source as the generator is consumed, so long streams can be faked
+        without holding them in memory.
+
+        Args:
+            - source: iterable, or function returning an iterator
+            - shared: when False every call iterates over source from the
+              start, which requires source to be a function or an iterable
+              that isn't an iterator itself. When True all calls take turns
+              consuming a single iterator, each one picking up where the
+              previous one stopped.
+
+        Returns:
+            - self, i.e. can be chained with other Expectation methods
+        """
+        if self._replace_with:
+            self.__raise(
+                FlexError, 'yields_from() cannot be specified after runs()')
+        if self._action['yield_values']:
+            self.__raise(FlexError, 'yields_from() can only be given once '
+                                    'and cannot be mixed with yields()')
+        if not shared and not callable(source) and iter(source) is source:
+            self.__raise(FlexError, 'an iterator can only be consumed once, '
+                                    'use shared=True or give a function')
+        self._action['yield_values'] = _YieldSource(source, shared)
+        self._changed()
         return self
 
     def runs(self, function=None):
@@ -184,6 +536,49 @@ class Expectation(object):
         if function == original_method:
             self._pass_thru = True
         self._replace_with = function
+        self._changed()
+        return self
+
+    def records(self, path):
+        """Runs the real method once and replays its outcome afterwards.
+
+        Like runs() without arguments, except that the arguments and result
+        of each call, including any exception raised, are saved to the
+        cassette file at path. Calls already in the cassette are replayed
+        from it without running the real method, so later test runs don't
+        touch the real dependency. Delete the file to record again.
+
+        Args:
+            - path: cassette file to record into and replay from
+
+        Returns:
+            - self, i.e. can be chained with other Expectation methods
+        """
+        from flex.cassette import _Recording
+        from flex.cassette import _get_cassette
+        self.runs()
+        self._recording = _Recording(_get_cassette(path))
+        self._changed()
+        return self
+
+    def latency(self, seconds):
+        """Delays results of a stubbed coroutine or async generator.
+
+        The delay is awaited before the return value is produced or the
+        exception raised, and before each value given to yields(), without
+        blocking the event loop.
+
+        Args:
+            - seconds: number of seconds to sleep for
+
+        Returns:
+            - self, i.e. can be chained with other Expectation methods
+        """
+        if not self._async:
+            self.__raise(
+                FlexError, 'latency() can only be used with async methods')
+        self._latency = seconds
+        self._changed()
         return self
 
     def times(self, start, end=0):
@@ -204,18 +599,25 @@ class Expectation(object):
         else:
             expected_calls[AT_LEAST] = start
             expected_calls[AT_MOST] = end
+        self.mock._Flex__verify_on_teardown(self)
+        self._changed()
         return self
 
     def ordered(self):
         """Makes the expectation respect the order of method statements.
 
         An exception will be raised if methods are called out of order,
-        determined by order of method calls in the test.
+        determined by order of method calls in the test. The order spans
+        every ordered expectation of the context, whichever object or
+        method they're on.
 
         Returns:
             - self, i.e. can be chained with other Expectation methods
         """
-        self._ordered = True
+        if not self._ordered:
+            self._ordered = True
+            self.mock._Flex__order(self)
+        self._changed()
         return self
 
     def when(self, func):
@@ -230,6 +632,7 @@ class Expectation(object):
         if not hasattr(func, '__call__'):
             self.__raise(FlexError, 'when() parameter must be callable')
         self._runnable = func
+        self._changed()
         return self
 
     def _verify(self, final=True):
@@ -245,67 +648,84 @@ class Expectation(object):
         if self._verified:
             return  # ensure we only raise one error per failed expectation
         failed = False
-        message = ''
+        called = self._times_called
         expected_calls = self._expected_calls
-        if expected_calls[EXACTLY] is not None:
-            message = 'exactly %s' % expected_calls[EXACTLY]
+        exactly = expected_calls[EXACTLY]
+        at_most = expected_calls[AT_MOST]
+        if exactly is not None:
             if final:
-                if self._times_called != expected_calls[EXACTLY]:
-                    failed = True
+                failed = called != exactly
             else:
-                if self._times_called > expected_calls[EXACTLY]:
-                    failed = True
+                failed = called > exactly
         else:
-            if final and expected_calls[AT_LEAST] is not None:
-                message = 'at least %s' % expected_calls[AT_LEAST]
-                if self._times_called < expected_calls[AT_LEAST]:
-                    failed = True
-            if expected_calls[AT_MOST] is not None:
-                if message:
-                    message += ' and '
-                message += 'at most %s' % expected_calls[AT_MOST]
-                if self._times_called > expected_calls[AT_MOST]:
-                    failed = True
+            at_least = expected_calls[AT_LEAST]
+            if final and at_least is not None and called < at_least:
+                failed = True
+            if at_most is not None and called > at_most:
+                failed = True
         if not failed:
             return
         else:
             self._verified = True
             self.__raise(
                 MethodCallError,
-                '%s expected to be called %s times, called %s times' %
-                    (_format_args(self.method, self.args),
-                    message,
-                    self._times_called))
+                _Message(_format_call_count, self.method, self.args,
+                         dict(expected_calls), final, called))
 
     def _reset(self):
         """Returns methods overriden by this expectation to their originals."""
         obj = self.mock._Flex__object
         original_method = self.original_method
         if original_method:
-            method = self.method
-            if (hasattr(obj, '__dict__') and
-                    method in obj.__dict__ and
-                    type(obj.__dict__) is dict):
-                del obj.__dict__[method]
-                if not hasattr(obj, method):
-                    obj.__dict__[method] = original_method
-            else:
-                setattr(obj, method, original_method)
+            _restore_method(obj, self.method, original_method)
         del self
 
-    def _verify_call_order(self, flex_objects):
-        for exp in flex_objects[self.mock]:
-            if (exp.method == self.method and
-                    not _match_args(self.args, exp.args) and
-                    not exp._times_called):
-                raise CallOrderError(
-                        '%s called before %s' %
-                        (_format_args(self.method, self.args),
-                         _format_args(exp.method, exp.args)))
-            if (exp.method == self.method and
-                    self.args and exp.args and    # ignore default stub case
-                    _match_args(self.args, exp.args)):
-                break
+    def _normalized_args(self):
+        """Returns args bound to the original method's signature, if known."""
+        args = self.args
+        if args is None:
+            return {'kargs': (), 'kwargs': {}}
+        if self._normalize is None or not args['kwargs']:
+            return args
+        kargs, kwargs = self._normalize(args['kargs'], args['kwargs'])
+        return {'kargs': kargs, 'kwargs': kwargs}
+
+    def _verify_call_order(self, context, kargs, kwargs):
+        """Checks every ordered expectation declared before this was called.
+
+        The context keeps a cursor on the first ordered expectation that
+        could still be out of order. Expectations past it have to be called
+        first, unless a newer expectation superseded them or the arguments
+        of this call would also have matched them. Once a call is in order
+        the cursor moves up to it, so each position is only examined once
+        over the course of a test.
+        """
+        ordered = context.ordered
+        order = self._order
+        with context.lock:
+            cursor = context.order_cursor
+            pending = None
+            for position in range(cursor, order):
+                exp = ordered[position]
+                if exp._times_called or exp._superseded():
+                    continue
+                if (exp.mock is self.mock and exp.method == self.method and
+                        (exp._matcher is None or
+                         exp._matcher.match(kargs, kwargs))):
+                    if pending is None:
+                        pending = position
+                    continue
+                # the call is out of order, only settled positions are passed
+                context.order_cursor = position if pending is None else pending
+                raise CallOrderError(_Message(
+                        _format_call_order, self.method, self.args,
+                        exp.method, exp.args))
+            if order > cursor:
+                context.order_cursor = order
+
+    def _superseded(self):
+        """Whether this can't be called anymore, hidden by a newer stub."""
+        return self.mock._Flex__superseded(self)
 
     def __raise(self, exception, message):
         """Safe internal raise implementation.
@@ -22,18 +22,109 @@ OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
 
 
+import collections
 import sys
 
 
+# history modes for fake objects, a positive int keeps only the last N calls
+HISTORY_ALL = 'all'
+HISTORY_COUNTS = 'counts'
+HISTORY_OFF = 'off'
+
+_UNSET = object()
+
+
+class _Call(object):
+    """Single entry of a fake object's call history.
+
+    Compares equal to the dict representation of the call, and supports
+    item access, membership tests, get(), keys() and iteration over the
+    fields that are set, so history entries can be treated like dicts.
+    """
+
+    __slots__ = ('name', 'kargs', 'kwargs', 'returned', 'raised')
+
+    def __init__(self, name, returned=_UNSET):
+        self.name = name
+        self.kargs = _UNSET
+        self.kwargs = _UNSET
+        self.returned = returned
+        self.raised = _UNSET
+
+    def _asdict(self):
+        return dict(self.items())
+
+    def __getitem__(self, field):
+        value = _UNSET
+        if field in self.__slots__:
+            value = getattr(self, field)
+        if value is _UNSET:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return (field in self.__slots__ and
+                getattr(self, field) is not _UNSET)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, field, default=None):
+        if field in self:
+            return getattr(self, field)
+        return default
+
+    def keys(self):
+        return [field for field in self.__slots__
+                if getattr(self, field) is not _UNSET]
+
+    def values(self):
+        return [getattr(self, field) for field in self.keys()]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, _Call):
+            other = other._asdict()
+        return self._asdict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._asdict())
+
+
 class _Fake(object):
 
-    def __init__(self, **kwargs):
+    def __init__(self, __history__=HISTORY_ALL, **kwargs):
         """Constructors the fake object.
 
         Args:
+            - __history__: how much call history to keep: HISTORY_ALL,
+              a number of most recent calls, HISTORY_COUNTS to only count
+              accesses per attribute in __counts__, or HISTORY_OFF
             - kwargs: dict of attribute/value pairs used to populate the object
         """
-        self.__calls__ = []
+        self.__counts__ = {}
+        if __history__ == HISTORY_ALL:
+            self.__calls__ = []
+            self.__record__ = self._append
+        elif __history__ == HISTORY_COUNTS:
+            self.__calls__ = []
+            self.__record__ = self._count
+        elif __history__ == HISTORY_OFF or __history__ is None:
+            self.__calls__ = []
+            self.__record__ = None
+        else:
+            self.__calls__ = collections.deque(maxlen=int(__history__))
+            self.__record__ = self._append
         for attr, value in kwargs.items():
             if hasattr(value, '__call__'):
                 setattr(self, attr, self._recordable(value))
@@ -50,23 +141,33 @@ class _Fake(object):
         calls = object.__getattribute__(self, '__calls__')
         if calls:
             call = calls[-1]
-            call['kargs'] = kargs
-            call['kwargs'] = kwargs
-            call['returned'] = self
+            call.kargs = kargs
+            call.kwargs = kwargs
+            call.returned = self
         return self
 
     def __getattribute__(self, name):
         attr = object.__getattribute__(self, name)
         if name not in ORIGINAL_FAKE_ATTRS:
-            calls = object.__getattribute__(self, '__calls__')
-            calls.append({'name': name, 'returned': attr})
+            record = object.__getattribute__(self, '__record__')
+            if record is not None:
+                record(name, attr)
         return attr
 
     def __getattr__(self, name):
-        calls = object.__getattribute__(self, '__calls__')
-        calls.append({'name': name, 'returned': self})
+        record = object.__getattribute__(self, '__record__')
+        if record is not None:
+            record(name, self)
         return self
 
+    def _append(self, name, returned):
+        calls = object.__getattribute__(self, '__calls__')
+        calls.append(_Call(name, returned))
+
+    def _count(self, name, returned):
+        counts = object.__getattribute__(self, '__counts__')
+        counts[name] = counts.get(name, 0) + 1
+
     def _recordable(self, func):
         def inner(*kargs, **kwargs):
             calls = object.__getattribute__(self, '__calls__')
@@ -74,17 +175,18 @@ class _Fake(object):
                 return func(*kargs, **kwargs)
             else:
                 call = calls[-1]
-                call['kargs'] = kargs
-                call['kwargs'] = kwargs
+                call.kargs = kargs
+                call.kwargs = kwargs
                 try:
                     ret = func(*kargs, **kwargs)
-                    call['returned'] = ret
+                    call.returned = ret
                     return ret
                 except:
-                    call['raised'] = sys.exc_info()
-                    del call['returned']
+                    call.raised = sys.exc_info()
+                    call.returned = _UNSET
                     raise
         return inner
 
 
-ORIGINAL_FAKE_ATTRS = dir(_Fake) + ['__calls__']
+ORIGINAL_FAKE_ATTRS = frozenset(
+        dir(_Fake) + ['__calls__', '__counts__', '__record__'])
@@ -23,12 +23,17 @@ ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
 
 
 import inspect
+import re
 import sys
 import types
+import weakref
+
+
+_PATTERN_TYPE = type(re.compile(''))
 
 
 def _arg_to_str(arg):
-    if '_sre.SRE_Pattern' in str(type(arg)):
+    if isinstance(arg, _PATTERN_TYPE):
         return '/%s/' % arg.pattern
     if isinstance(arg, tuple):
         args = ', '.join([_arg_to_str(a) for a in arg])
@@ -62,40 +67,369 @@ def _format_args(method, arguments):
     return '%s(%s)' % (method, args)
 
 
-def _match_args(given_args, expected_args):
-    if (given_args == expected_args or expected_args is None):
+# types whose equality is consistent with their hash and can't be overridden
+# by the caller, making them safe to use as dispatch index keys
+if sys.version_info < (3, 0):
+    _LITERAL_TYPES = frozenset(
+            [type(None), bool, int, long, float, complex, str, unicode])
+else:
+    _LITERAL_TYPES = frozenset(
+            [type(None), bool, int, float, complex, str, bytes])
+
+
+def _is_literal(arg):
+    arg_type = type(arg)
+    if arg_type is tuple or arg_type is frozenset:
+        for a in arg:
+            if not _is_literal(a):
+                return False
+        return True
+    return arg_type in _LITERAL_TYPES
+
+
+def _literal_key(arguments):
+    """Builds a hashable key for arguments made up entirely of literals.
+
+    Returns None if any of the arguments is not a literal, in which case
+    matching has to fall back to running the compiled matcher.
+    """
+    kargs = arguments['kargs']
+    kwargs = arguments['kwargs']
+    for arg in kargs:
+        if not _is_literal(arg):
+            return None
+    for arg in kwargs.values():
+        if not _is_literal(arg):
+            return None
+    return (kargs, frozenset(kwargs.items()))
+
+
+class _ArgsMatcher(object):
+    """Argument spec of an expectation compiled into per-argument predicates.
+
+    Works out once whether each expected argument is a literal, a class or a
+    regex so matching a call only runs the predicates.
+    """
+
+    __slots__ = ('kargs', 'kwargs', 'keys', 'key')
+
+    def __init__(self, arguments):
+        self.kargs = tuple(
+                [_compile_arg(arg) for arg in arguments['kargs']])
+        self.kwargs = dict(
+                [(k, _compile_arg(v)) for k, v in arguments['kwargs'].items()])
+        self.keys = frozenset(self.kwargs)
+        self.key = _literal_key(arguments)
+
+    def match(self, kargs, kwargs):
+        predicates = self.kargs
+        if len(kargs) != len(predicates) or len(kwargs) != len(self.keys):
+            return False
+        for i, arg in enumerate(kargs):
+            if not predicates[i](arg):
+                return False
+        predicates = self.kwargs
+        for k, v in kwargs.items():
+            predicate = predicates.get(k)
+            if predicate is None or not predicate(v):
+                return False
+        return True
+
+
+def _equals(arg, expected_arg):
+    """Equality that copes with array-likes returning elementwise results."""
+    if arg is expected_arg:
         return True
-    if (len(given_args['kargs']) != len(expected_args['kargs']) or
-            len(given_args['kwargs']) != len(expected_args['kwargs']) or
-            given_args['kwargs'].keys() != expected_args['kwargs'].keys()):
+    result = arg == expected_arg
+    if result is True or result is False:
+        return result
+    try:
+        return bool(result)
+    except ValueError:  # truth value of a multi-element array is ambiguous
         return False
-    for i, arg in enumerate(given_args['kargs']):
-        if not _arguments_match(arg, expected_args['kargs'][i]):
+
+
+def _ndarray_type():
+    """Returns numpy.ndarray if numpy has been imported, without importing it."""
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return None
+    return getattr(numpy, 'ndarray', None)
+
+
+def _compile_arg(expected_arg):
+    """Returns a predicate checking a single argument against expected_arg."""
+    if _isclass(expected_arg):
+        def match_class(arg):
+            return _equals(arg, expected_arg) or isinstance(arg, expected_arg)
+        return match_class
+    elif isinstance(expected_arg, _PATTERN_TYPE):
+        search = expected_arg.search
+        def match_regex(arg):
+            if _equals(arg, expected_arg):
+                return True
+            try:
+                return search(arg) is not None
+            except TypeError:  # not a string, or bytes against str pattern
+                return False
+        return match_regex
+    elif type(expected_arg) in _BUFFER_TYPES:
+        return _compile_buffer(expected_arg)
+    ndarray = _ndarray_type()
+    if ndarray is not None and isinstance(expected_arg, ndarray):
+        return _compile_array(expected_arg, ndarray)
+    def match_literal(arg):
+        return _equals(arg, expected_arg)
+    return match_literal
+
+
+_BUFFER_TYPES = frozenset([bytearray, memoryview])
+if sys.version_info >= (3, 0):
+    _BUFFER_TYPES = _BUFFER_TYPES | frozenset([bytes])
+
+
+def _compile_buffer(expected_arg):
+    """Matches bytes-like arguments, rejecting on size or hash before comparing.
+
+    bytes cache their hash, so a large bytes argument passed to many calls or
+    checked against many expectations is only hashed once. No view is kept
+    on mutable buffers, as it would keep their owner from resizing them.
+    """
+    if type(expected_arg) is memoryview and not _is_byte_view(expected_arg):
+        def match_literal(arg):
+            return _equals(arg, expected_arg)
+        return match_literal
+    expected_view = expected_hash = None
+    if type(expected_arg) is bytes:
+        expected_view = memoryview(expected_arg)
+        expected_hash = hash(expected_arg)
+    def compare(arg, arg_type, view):
+        size = view.nbytes
+        if arg_type is memoryview:
+            if arg.nbytes != size:
+                return False
+            with arg.cast('B') as flat:
+                return flat == view
+        if len(arg) != size:
             return False
-    for k, v in given_args['kwargs'].items():
-        if not _arguments_match(v, expected_args['kwargs'][k]):
+        if expected_hash is not None and arg_type is bytes:
+            if hash(arg) != expected_hash:
+                return False
+            return arg == expected_arg
+        with memoryview(arg) as other:
+            return other == view
+    def match_buffer(arg):
+        if arg is expected_arg:
+            return True
+        arg_type = type(arg)
+        if arg_type not in _BUFFER_TYPES:
+            return _equals(arg, expected_arg)
+        if arg_type is memoryview and not _is_byte_view(arg):
+            return _equals(arg, expected_arg)
+        if expected_view is not None:
+            return compare(arg, arg_type, expected_view)
+        with memoryview(expected_arg) as view:
+            with view.cast('B') as flat:
+                return compare(arg, arg_type, flat)
+    return match_buffer
+
+
+def _is_byte_view(view):
+    """Whether view can be compared to bytes as a flat array of bytes."""
+    return view.c_contiguous and view.format == 'B'
+
+
+def _compile_array(expected_arg, ndarray):
+    """Matches numpy arrays, rejecting on shape and dtype before comparing.
+
+    The elements are compared on every call, even read-only arrays can be
+    views of an array that is still written to.
+    """
+    numpy = sys.modules['numpy']
+    shape = expected_arg.shape
+    dtype = expected_arg.dtype
+    def match_array(arg):
+        if arg is expected_arg:
+            return True
+        if not isinstance(arg, ndarray):
             return False
-    return True
+        if arg.shape != shape or arg.dtype != dtype:
+            return False
+        return bool(numpy.array_equal(arg, expected_arg))
+    return match_array
 
 
-def _arguments_match(arg, expected_arg):
-    if arg == expected_arg:
-        return True
-    elif _isclass(expected_arg) and isinstance(arg, expected_arg):
-        return True
-    elif ('_sre.SRE_Pattern' in str(type(expected_arg)) and
-                expected_arg.search(arg)):
-        return True
+# class or module -> {method name: normalizer or None}, weakly keyed so
+# classes defined inside tests can still be collected
+_normalizers = weakref.WeakKeyDictionary()
+
+
+def _get_normalizer(obj, method, original_method):
+    """Returns a function putting call arguments of method in canonical form.
+
+    The signature of the original method is looked up once per class (or
+    module) and method name. Methods set on the instance itself aren't
+    cached since they can differ between instances.
+
+    Args:
+        - obj: object whose method is being stubbed
+        - method: string name of the method
+        - original_method: the method being replaced
+
+    Returns:
+        - normalizer, or None if the signature can't be determined
+    """
+    if inspect.ismodule(obj) or _isclass(obj):
+        owner = obj
+    elif hasattr(obj, '__dict__') and method in obj.__dict__:
+        return _create_normalizer(obj, method, original_method)
     else:
-        return False
+        owner = type(obj)
+    try:
+        cached = _normalizers.setdefault(owner, {})
+    except TypeError:  # owner not weak referenceable
+        return _create_normalizer(obj, method, original_method)
+    if method not in cached:
+        cached[method] = _create_normalizer(obj, method, original_method)
+    return cached[method]
+
+
+def _create_normalizer(obj, method, original_method):
+    signature = getattr(inspect, 'signature', None)
+    if signature is None or original_method is None:
+        return None
+    method_type = type(original_method)
+    if _isclass(obj) and method_type is not staticmethod:
+        # inherited static methods are plain functions once looked up, only
+        # the descriptor found through the MRO tells them from methods
+        getattr_static = getattr(inspect, 'getattr_static', None)
+        if getattr_static is not None and type(
+                getattr_static(obj, method, None)) is staticmethod:
+            method_type = staticmethod
+    if type(original_method) in (staticmethod, classmethod):
+        function = original_method.__func__
+    else:
+        function = original_method
+    try:
+        signature = signature(function)
+    except (TypeError, ValueError):  # builtins and other uninspectables
+        return None
+    parameters = list(signature.parameters.values())
+    # functions looked up in the class __dict__ are called through the stub
+    # without their first argument
+    if method_type is classmethod or (
+            method_type is not staticmethod and _isclass(obj) and
+            inspect.isfunction(function)):
+        if not parameters or parameters[0].kind not in (
+                parameters[0].POSITIONAL_ONLY,
+                parameters[0].POSITIONAL_OR_KEYWORD):
+            return None
+        parameters = parameters[1:]
+        signature = signature.replace(parameters=parameters)
+    return _Normalizer(signature)
+
+
+class _Normalizer(object):
+    """Binds arguments to a signature, turning them into a canonical form.
+
+    Arguments that can be passed positionally are moved into kargs so that
+    foo(1, b=2) and foo(1, 2) compare the same, everything else ends up in
+    kwargs. Defaults aren't filled in, and arguments that don't bind are
+    left as they were.
+    """
+
+    __slots__ = ('bind', 'parameters')
 
+    def __init__(self, signature):
+        self.bind = signature.bind
+        self.parameters = tuple(
+                [(p.name, p.kind) for p in signature.parameters.values()])
 
-def _isclass(obj):
-    """Fixes stupid bug in inspect.isclass from < 2.7."""
-    if sys.version_info < (2, 7):
+    def __call__(self, kargs, kwargs):
+        if not kwargs:
+            # binding only ever moves keyword arguments
+            return kargs, kwargs
+        try:
+            arguments = self.bind(*kargs, **kwargs).arguments
+        except TypeError:
+            return kargs, kwargs
+        kargs = []
+        kwargs = {}
+        positional = True
+        for name, kind in self.parameters:
+            if name not in arguments:
+                if kind in _POSITIONAL_KINDS:
+                    positional = False
+                continue
+            value = arguments[name]
+            if kind == _VAR_POSITIONAL:
+                kargs.extend(value)
+            elif kind == _VAR_KEYWORD:
+                kwargs.update(value)
+            elif positional and kind in _POSITIONAL_KINDS:
+                kargs.append(value)
+            else:
+                kwargs[name] = value
+        return tuple(kargs), kwargs
+
+
+if hasattr(inspect, 'Parameter'):
+    _POSITIONAL_KINDS = (inspect.Parameter.POSITIONAL_ONLY,
+                         inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    _VAR_POSITIONAL = inspect.Parameter.VAR_POSITIONAL
+    _VAR_KEYWORD = inspect.Parameter.VAR_KEYWORD
+
+
+def _match_args(given_args, expected_args):
+    if expected_args is None:
+        return True
+    return _ArgsMatcher(expected_args).match(
+            given_args['kargs'], given_args['kwargs'])
+
+
+def _arguments_match(arg, expected_arg):
+    return bool(_compile_arg(expected_arg)(arg))
+
+
+if sys.version_info < (2, 7):
+    def _isclass(obj):
+        """Fixes stupid bug in inspect.isclass from < 2.7."""
         return isinstance(obj, (type, types.ClassType))
+else:
+    _isclass = inspect.isclass
+
+
+COROUTINE = 'coroutine'
+ASYNC_GENERATOR = 'async generator'
+
+
+def _async_kind(func):
+    """Tells whether func is a coroutine or async generator function.
+
+    Returns:
+        COROUTINE, ASYNC_GENERATOR or None for regular callables
+    """
+    if type(func) is classmethod or type(func) is staticmethod:
+        func = func.__func__
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    isasyncgenfunction = getattr(inspect, 'isasyncgenfunction', None)
+    if iscoroutinefunction and iscoroutinefunction(func):
+        return COROUTINE
+    if isasyncgenfunction and isasyncgenfunction(func):
+        return ASYNC_GENERATOR
+    return None
+
+
+def _restore_method(obj, method, original_method):
+    """Puts back the original of a method replaced by flex."""
+    if (hasattr(obj, '__dict__') and
+            method in obj.__dict__ and
+            type(obj.__dict__) is dict):
+        del obj.__dict__[method]
+        if not hasattr(obj, method):
+            obj.__dict__[method] = original_method
     else:
-        return inspect.isclass(obj)
+        setattr(obj, method, original_method)
 
 
 def _get_code(func):
@@ -0,0 +1,124 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+import atexit
+import gc
+import sys
+import types
+
+from flex.context import _contexts
+from flex.profiling import _describe
+
+
+# not followed when measuring what a flexed object retains, as they're
+# shared by everything and outlive any test
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.CodeType,
+                 types.BuiltinFunctionType)
+
+
+def pinned():
+    """Lists the objects flex still holds on to, in every context.
+
+    Objects are held from the time they're flexed until the next verify(),
+    or for stubs without times() or ordered(), as long as something else
+    references them. Anything listed after the last test has finished was
+    never torn down.
+
+    Returns:
+        - list of dicts with the object, the methods still stubbed and the
+          approximate number of bytes it retains, largest first
+    """
+    found = []
+    for context in list(_contexts):
+        with context.lock:
+            mocks = list(context.objects)
+        for mock in mocks:
+            obj = mock._Flex__object
+            found.append({
+                'object': _describe(obj),
+                'methods': sorted(mock._Flex__patched),
+                'retained': _retained_size(obj),
+            })
+    found.sort(key=lambda x: x['retained'], reverse=True)
+    return found
+
+
+def _retained_size(obj):
+    """Approximates the memory reachable from obj, not counting shared state.
+
+    Classes, modules and functions are only counted when they're the
+    flexed object itself.
+    """
+    seen = set([id(obj)])
+    pending = [obj]
+    size = 0
+    while pending:
+        current = pending.pop()
+        try:
+            size += sys.getsizeof(current)
+        except TypeError:
+            pass
+        for referent in gc.get_referents(current):
+            if id(referent) in seen or isinstance(referent, _SHARED_TYPES):
+                continue
+            seen.add(id(referent))
+            pending.append(referent)
+    return size
+
+
+def report(limit=20):
+    """Returns a text table of the objects flex still holds on to."""
+    found = pinned()
+    if not found:
+        return 'flex holds no objects'
+    lines = ['%-40s %12s  %s' % ('object', 'retained (B)', 'stubbed methods')]
+    for entry in found[:limit]:
+        label = entry['object']
+        if len(label) > 40:
+            label = label[:37] + '...'
+        lines.append('%-40s %12d  %s' % (
+                label, entry['retained'], ', '.join(entry['methods'])))
+    if len(found) > limit:
+        lines.append('... and %d more' % (len(found) - limit))
+    return '\n'.join(lines)
+
+
+def write_report(output=None):
+    """Writes the report to output, or stderr, if flex holds any objects."""
+    if not pinned():
+        return
+    text = report()
+    if output:
+        f = open(output, 'w')
+        try:
+            f.write(text + '\n')
+        finally:
+            f.close()
+    else:
+        sys.stderr.write(text + '\n')
+
+
+def report_at_exit(output=None):
+    """Writes the report when the process exits, see write_report()."""
+    atexit.register(write_report, output)
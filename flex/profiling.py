@@ -0,0 +1,237 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+
+import atexit
+import json
+import sys
+import threading
+import time
+
+from flex.helpers import _format_args
+
+
+try:
+    _timer = time.perf_counter
+except AttributeError:  # < 3.3
+    _timer = time.time
+
+
+TABLE = 'table'
+JSON = 'json'
+
+# The active profiler, None unless profiling was enabled. Stubbed methods and
+# verify() check this before doing any timing.
+_profiler = None
+
+
+class _Histogram(object):
+    """Latency histogram with power of two microsecond buckets.
+
+    Bucket n counts durations of at least 2**(n-1) and less than 2**n
+    microseconds, bucket 0 the ones under a microsecond.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        bucket = int(duration * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def to_dict(self):
+        buckets = {}
+        for bucket, count in sorted(self.buckets.items()):
+            buckets['<%dus' % (2 ** bucket)] = count
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': buckets}
+
+
+class _StubStats(object):
+    """Timings of calls to stubbed methods that matched one expectation."""
+
+    def __init__(self, label):
+        self.label = label
+        self.calls = 0
+        self.match_time = 0.0
+        self.runs_time = 0.0
+        self.latency = _Histogram()
+
+    def to_dict(self):
+        return {'stub': self.label, 'calls': self.calls,
+                'match_time': self.match_time, 'runs_time': self.runs_time,
+                'latency': self.latency.to_dict()}
+
+
+class _Profiler(object):
+    """Collects timings of flex machinery for the whole session."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stub label -> _StubStats, stubs with the same object, method and
+        # arguments in different tests are aggregated together
+        self.stubs = {}
+        self.unmatched = _Histogram()
+        self.teardown = _Histogram()
+
+    def call(self, mock, method, match, respond, kargs, kwargs):
+        """Runs a stubbed method call, timing matching and the response."""
+        started = _timer()
+        try:
+            expectation = match(kargs, kwargs)
+        except Exception:
+            with self.lock:
+                self.unmatched.add(_timer() - started)
+            raise
+        matched = _timer()
+        try:
+            return respond(expectation, kargs, kwargs)
+        finally:
+            finished = _timer()
+            stats = self._stats(mock, expectation)
+            with self.lock:
+                stats.calls += 1
+                stats.match_time += matched - started
+                if (expectation._replace_with is not None or
+                        expectation._recording is not None):
+                    stats.runs_time += finished - matched
+                stats.latency.add(finished - started)
+
+    def _stats(self, mock, expectation):
+        stats = expectation._stats
+        if stats is None or self.stubs.get(stats.label) is not stats:
+            label = '%s.%s' % (_describe(mock._Flex__object),
+                               _format_args(expectation.method,
+                                            expectation.args))
+            with self.lock:
+                stats = self.stubs.get(label)
+                if stats is None:
+                    stats = self.stubs[label] = _StubStats(label)
+            expectation._stats = stats
+        return stats
+
+    def record_teardown(self, duration):
+        with self.lock:
+            self.teardown.add(duration)
+
+    def to_dict(self):
+        with self.lock:
+            stubs = sorted(self.stubs.values(),
+                           key=lambda x: x.latency.total, reverse=True)
+            return {
+                'stubs': [x.to_dict() for x in stubs],
+                'unmatched_calls': self.unmatched.to_dict(),
+                'teardown': self.teardown.to_dict(),
+            }
+
+    def summary(self, limit=20):
+        """Formats the slowest stubs and teardown totals as a text table."""
+        report = self.to_dict()
+        lines = ['%-50s %10s %12s %12s %12s %12s' % (
+                 'stub', 'calls', 'total (s)', 'match (s)', 'runs (s)',
+                 'max (s)')]
+        for stub in report['stubs'][:limit]:
+            label = stub['stub']
+            if len(label) > 50:
+                label = label[:47] + '...'
+            lines.append('%-50s %10d %12.6f %12.6f %12.6f %12.6f' % (
+                label, stub['calls'], stub['latency']['total'],
+                stub['match_time'], stub['runs_time'],
+                stub['latency']['max']))
+        teardown = report['teardown']
+        lines.append('')
+        lines.append('%d stubs, %d teardowns taking %.6fs (max %.6fs)' % (
+            len(report['stubs']), teardown['count'], teardown['total'],
+            teardown['max']))
+        unmatched = report['unmatched_calls']
+        if unmatched['count']:
+            lines.append('%d unmatched calls taking %.6fs' % (
+                unmatched['count'], unmatched['total']))
+        return '\n'.join(lines)
+
+
+def _describe(obj):
+    name = getattr(obj, '__name__', None)
+    if name is None:
+        return '<%s instance>' % type(obj).__name__
+    return name
+
+
+def enable(report=None, output=None):
+    """Starts collecting timings of stubbed calls and teardown.
+
+    Args:
+        - report: TABLE or JSON to write a report when the process exits
+        - output: file path for the report, defaults to stderr
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = _Profiler()
+    if report:
+        atexit.register(write_report, report, output)
+
+
+def disable():
+    """Stops profiling and discards collected timings."""
+    global _profiler
+    _profiler = None
+
+
+def summary(limit=20):
+    """Returns a text table of the slowest stubs, None if not profiling."""
+    if _profiler is None:
+        return None
+    return _profiler.summary(limit)
+
+
+def to_json():
+    """Returns the collected timings as JSON, None if not profiling."""
+    if _profiler is None:
+        return None
+    return json.dumps(_profiler.to_dict(), indent=2, sort_keys=True)
+
+
+def write_report(report=TABLE, output=None):
+    """Writes a TABLE or JSON report of the collected timings."""
+    if _profiler is None:
+        return
+    if report == JSON:
+        text = to_json()
+    else:
+        text = summary()
+    if output:
+        f = open(output, 'w')
+        try:
+            f.write(text + '\n')
+        finally:
+            f.close()
+    else:
+        sys.stderr.write(text + '\n')
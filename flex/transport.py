@@ -0,0 +1,184 @@
+"""Copyright 2011 Herman Sheremetyev. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice,
+   this list of conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.  """
+
+
+import inspect
+import multiprocessing
+import os
+
+from flex.context import _current_context
+from flex.exceptions import FlexError
+from flex.expectation import Expectation
+from flex.helpers import _isclass
+
+
+def export(mp_context=None):
+    """Packages the stubs of the current context for worker processes.
+
+    Pass the result to install() in each worker, typically as the
+    initializer of a pool:
+
+        >>> pool = multiprocessing.Pool(
+        ...     initializer=transport.install, initargs=(transport.export(),))
+
+    Only stubs on classes and modules are exported, instances live in a
+    single process so stub their class instead. Functions given to runs()
+    must be picklable, and records() runs the real method in workers
+    without recording. Calls made by the workers count towards the
+    expectations checked by verify() in this process.
+
+    Args:
+        - mp_context: multiprocessing context the workers are started with,
+          defaults to the multiprocessing module's default one
+
+    Returns:
+        - _Transport to hand to install()
+    """
+    context = _current_context()
+    with context.lock:
+        expectations = []
+        for mock, mock_expectations in context.objects.items():
+            obj = mock._Flex__object
+            if not (_isclass(obj) or inspect.ismodule(obj)):
+                continue
+            expectations.extend(
+                    [e for e in mock_expectations if e.method is not None])
+        transport = _Transport(expectations, mp_context or multiprocessing)
+        context.transports.append(transport)
+    return transport
+
+
+def install(transport):
+    """Installs stubs exported by export(), in a worker process.
+
+    Args:
+        - transport: _Transport returned by export()
+    """
+    for token, expectation in enumerate(transport.expectations):
+        # unpickled when the worker was spawned, or a copy of the parent's
+        # if it was forked, either way only the pickled state is kept
+        clone = Expectation.__new__(Expectation)
+        clone.__setstate__(expectation.__getstate__())
+        clone._transport = _SharedCounter(transport.counters, token)
+        clone.mock._Flex__adopt(clone)
+
+
+def share(capacity=4096, mp_context=None):
+    """Counts calls made by forked child processes towards verify().
+
+    Forked children inherit the stubs, but calls they make only count in
+    their own copy of each expectation. From now on every stub of the
+    current context, existing or created later in this process, gets a
+    counter in memory shared with the children, which verify() adds to
+    the calls made here. Stops at the next verify().
+
+    Args:
+        - capacity: maximum number of stubs that can be counted
+        - mp_context: multiprocessing context the children are started
+          with, which has to use fork
+
+    Returns:
+        - _SharedCounters
+    """
+    context = _current_context()
+    with context.lock:
+        if context.counters is None:
+            counters = _SharedCounters(capacity, mp_context or multiprocessing)
+            for expectations in context.objects.values():
+                for expectation in expectations:
+                    if expectation.method is not None:
+                        counters.assign(expectation)
+            context.counters = counters
+            context.transports.append(counters)
+    return context.counters
+
+
+class _SharedCounters(object):
+    """Call counters in shared memory, written by forked child processes.
+
+    Calls made in the process that created them are already counted by
+    the expectations themselves, so only the children write to them.
+    """
+
+    def __init__(self, capacity, mp_context):
+        self.counts = mp_context.RawArray('q', capacity)
+        self.lock = mp_context.Lock()
+        self.owner = os.getpid()
+        self.expectations = []
+
+    def assign(self, expectation):
+        """Gives expectation the next free counter."""
+        if os.getpid() != self.owner:
+            return
+        slot = len(self.expectations)
+        if slot >= len(self.counts):
+            raise FlexError('all %s shared counters are in use, '
+                            'raise the capacity given to share()' % slot)
+        self.expectations.append(expectation)
+        expectation._transport = _SharedCounter(self, slot)
+        expectation._changed()
+
+    def collect(self):
+        """Adds the calls made by child processes to the expectations."""
+        counts = self.counts
+        with self.lock:
+            for slot, expectation in enumerate(self.expectations):
+                count = counts[slot]
+                if count:
+                    counts[slot] = 0
+                    with expectation._lock:
+                        expectation._times_called += count
+
+
+class _SharedCounter(object):
+
+    __slots__ = ('counters', 'slot')
+
+    def __init__(self, counters, slot):
+        self.counters = counters
+        self.slot = slot
+
+    def __call__(self):
+        counters = self.counters
+        if os.getpid() == counters.owner:
+            return
+        with counters.lock:
+            counters.counts[self.slot] += 1
+
+
+class _Transport(object):
+    """Stubs sent to worker processes, and the counters they report calls in.
+
+    Workers count their calls in shared memory rather than sending each
+    one to this process, which only reads them in verify() and so can't
+    keep a pipe from filling up while the workers are busy.
+    """
+
+    def __init__(self, expectations, mp_context):
+        self.expectations = expectations
+        self.counters = _SharedCounters(max(len(expectations), 1), mp_context)
+        self.counters.expectations = list(expectations)
+
+    def collect(self):
+        """Adds the calls reported by workers to the exported expectations."""
+        self.counters.collect()
@@ -26,38 +26,62 @@ import inspect
 import sys
 import types
 
+from flex import profiling
+from flex.context import _current_context
+from flex.context import _global_context
+from flex.helpers import ASYNC_GENERATOR
 from flex.helpers import _arguments_match
+from flex.helpers import _async_kind
+from flex.helpers import _get_normalizer
 from flex.helpers import _isclass
 from flex.helpers import _format_args
-from flex.helpers import _match_args
+from flex.helpers import _literal_key
 from flex.helpers import _get_runnable_name
 from flex.expectation import Expectation
+from flex.expectation import RAISE
 from flex.expectation import ReturnValue
+from flex.expectation import _always_runnable
+from flex.expectation import _Template
+from flex.expectation import _yielded
 from flex.exceptions import FlexError
 from flex.exceptions import StateError
 from flex.exceptions import MethodSignatureError
 from flex.exceptions import MockBuiltinError
+from flex.exceptions import _Message
 
 
 # Holds global hash of object/expectation mappings
-_flex_objects = {}
+_flex_objects = _global_context.objects
 
 
 class _Flex(object):
     """Flex object returned by the flex() function."""
 
-    def __init__(self, spec):
+    def __init__(self, spec, context=None):
         """Flex constructor.
 
         Args:
             - spec: object, class or module to flex
+            - context: _Context to register with, defaults to the current one
         """
+        if context is None:
+            context = _current_context()
         self.__object = spec
+        self.__context = context
+        self.__dispatch = {}
+        # method name -> original method, for the methods replaced
+        self.__patched = {}
+        # method name -> one item list holding the call handler specialized
+        # for its expectations, None until the next call works it out
+        self.__specialized = {}
+        self.__expectations = None
         expectation = Expectation(self)
-        if self in _flex_objects:
-            _flex_objects[self].append(expectation)
-        else:
-            _flex_objects[self] = [expectation]
+        with context.lock:
+            if self in context.objects:
+                context.objects[self].append(expectation)
+            else:
+                context.objects[self] = [expectation]
+            context.ids[id(spec)] = self
 
     def __getattribute__(self, name):
         # TODO(herman): this sucks, generalize this!
@@ -71,6 +95,14 @@ class _Flex(object):
     def __getattr__(self, name):
         return self.__stubs(name)
 
+    def __reduce__(self):
+        # unpickles as the _Flex for the same object in the other process,
+        # modules are looked up by name as they can't be pickled
+        obj = self.__object
+        if inspect.ismodule(obj):
+            return _get_module_flex, (obj.__name__,)
+        return _get_flex, (obj,)
+
     def __stubs(self, method):
         """Replaces a method with a fake one.
 
@@ -80,8 +112,44 @@ class _Flex(object):
         Returns:
             - Expectation object
         """
+        method = self.__method_name(method)
+        self.__check_method(method)
+        with self.__context.lock:
+            return self.__install(method)
+
+    def __stub_all(self, stubs):
+        """Replaces several methods in a single pass.
+
+        Every method name is checked before anything is replaced, so a
+        missing method leaves the object untouched, and the context lock is
+        only taken once.
+
+        Args:
+            - stubs: template() or dict, or iterable of pairs, of method name
+              to either a return value or a stub() spec
+
+        Returns:
+            - list of Expectation objects, in the order given
+        """
+        if not isinstance(stubs, _Template):
+            stubs = _Template(stubs)
+        entries = [(self.__method_name(entry.method), entry)
+                   for entry in stubs.entries]
+        for method, _ in entries:
+            self.__check_method(method)
+        with self.__context.lock:
+            return [self.__install(method, entry) for method, entry in entries]
+
+    def __adopt(self, expectation):
+        """Installs an expectation unpickled from another process."""
+        method = expectation.method
+        self.__check_method(method)
+        with self.__context.lock:
+            return self.__install(method, adopted=expectation)
+
+    def __method_name(self, method):
+        """Applies name mangling to private method names."""
         obj = self.__object
-        return_value = None
         if (method.startswith('__') and not method.endswith('__') and
                 not inspect.ismodule(obj)):
             if _isclass(obj):
@@ -89,29 +157,129 @@ class _Flex(object):
             else:
                 name = obj.__class__.__name__
             method = '_%s__%s' % (name.lstrip('_'), method.lstrip('_'))
+        return method
+
+    def __check_method(self, method):
+        obj = self.__object
         if not isinstance(obj, _Flex) and not hasattr(obj, method):
             raise FlexError('%s does not have method %s' % (obj, method))
-        if self not in _flex_objects:
-            _flex_objects[self] = []
-        expectation = self.__create_expectation(method, return_value)
-        if expectation not in _flex_objects[self]:
-            try:
-                self.__update_method(expectation, method)
-                _flex_objects[self].append(expectation)
-            except TypeError:
-                raise MockBuiltinError(
-                    'Python does not allow updating builtin objects. '
-                    'Consider wrapping it in a class you can mock instead')
-            except AttributeError:
-                raise MockBuiltinError(
-                    'Python does not allow updating instances of builtins. '
-                    'Consider wrapping it in a class you can mock instead')
+
+    def __install(self, method, entry=None, adopted=None):
+        """Creates an expectation for method and puts the stub in place.
+
+        Must be called with the context lock held.
+
+        Args:
+            - method: string name of the method to stub
+            - entry: optional _TemplateEntry to set up the expectation with
+            - adopted: optional Expectation to install instead of a new one
+        """
+        obj = self.__object
+        context = self.__context
+        if self not in context.objects:
+            context.objects[self] = []
+            context.ids[id(obj)] = self
+            self.__dispatch = {}
+            self.__patched = {}
+        if adopted is None:
+            expectation = self.__create_expectation(method)
+        else:
+            expectation = adopted
+            existing = self.__dispatch.get(method)
+            if existing:
+                first = existing['all'][0]
+                expectation.original_method = first.original_method
+                if 'original_function' in first.__dict__:
+                    expectation.original_function = first.original_function
+        try:
+            self.__update_method(expectation, method)
+            if entry is not None:
+                entry.instantiate(expectation)
+            elif adopted is not None:
+                adopted._adopt()
+            context.objects[self].append(expectation)
+            if method not in self.__patched:
+                self.__patched[method] = expectation.original_method
+            self.__reindex(expectation)
+            if context.counters is not None:
+                context.counters.assign(expectation)
+        except TypeError:
+            raise MockBuiltinError(
+                'Python does not allow updating builtin objects. '
+                'Consider wrapping it in a class you can mock instead')
+        except AttributeError:
+            raise MockBuiltinError(
+                'Python does not allow updating instances of builtins. '
+                'Consider wrapping it in a class you can mock instead')
         return expectation
 
+    def __verify_on_teardown(self, expectation):
+        """Marks expectation as needing verification when torn down."""
+        context = self.__context
+        with context.lock:
+            if self in context.objects:
+                context.verifiable[expectation] = self
+
+    def __order(self, expectation):
+        """Gives expectation the next place in the context's call order."""
+        context = self.__context
+        with context.lock:
+            if self in context.objects:
+                expectation._order = len(context.ordered)
+                context.ordered.append(expectation)
+                context.verifiable[expectation] = self
+
+    def __index(self, expectation):
+        """Adds expectation to the dispatch index for its method.
+
+        The index keeps, per method name, every expectation in definition
+        order along with a hash table of expectations whose arguments are
+        all literals. Expectations using class or regex matchers (or no
+        arguments at all) are kept in a separate list that is scanned.
+        Called again whenever the expectation's arguments are specified.
+        """
+        with self.__context.lock:
+            self.__reindex(expectation)
+
+    def __respecialize(self, method=None):
+        """Drops the call handler specialized for method, or all of them."""
+        with self.__context.lock:
+            if method is None:
+                states = self.__specialized.values()
+            else:
+                states = [self.__specialized.get(method)]
+            for state in states:
+                if state is not None:
+                    state[0] = None
+
+    def __reindex(self, expectation):
+        self.__respecialize(expectation.method)
+        dispatch = self.__dispatch
+        if expectation.method not in dispatch:
+            dispatch[expectation.method] = {
+                'all': [], 'literal': {}, 'scan': [], 'seq': {}}
+        entry = dispatch[expectation.method]
+        seq = entry['seq']
+        if expectation in seq:
+            entry['scan'].remove(expectation)
+        else:
+            seq[expectation] = len(entry['all'])
+            entry['all'].append(expectation)
+        key = None
+        if expectation._matcher is not None:
+            key = expectation._matcher.key
+        if key is None:
+            entry['scan'].append(expectation)
+            entry['scan'].sort(key=seq.get)
+        else:
+            previous = entry['literal'].get(key)
+            if previous is None or seq[previous] < seq[expectation]:
+                entry['literal'][key] = expectation
+
     def __create_expectation(self, method, return_value=None):
-        if method in [x.method for x in _flex_objects[self]]:
-            expectation = [x for x in _flex_objects[self]
-                           if x.method == method][0]
+        entry = self.__dispatch.get(method)
+        if entry:
+            expectation = entry['all'][0]
             original_method = expectation.original_method
             expectation = Expectation(
                     self, name=method, return_value=return_value,
@@ -124,7 +292,6 @@ class _Flex(object):
     def __update_method(self, expectation, method):
         obj = self.__object
         original_method = expectation.original_method
-        meth = self.__create_mock_method(method)
         if hasattr(obj, method) and not original_method:
             if hasattr(obj, '__dict__') and method in obj.__dict__:
                 expectation.original_method = obj.__dict__[method]
@@ -133,6 +300,10 @@ class _Flex(object):
             method_type = type(expectation.original_method)
             if method_type is classmethod or method_type is staticmethod:
                 expectation.original_function = getattr(obj, method)
+        expectation._async = _async_kind(expectation.original_method)
+        expectation._normalize = _get_normalizer(
+                obj, method, expectation.original_method)
+        meth = self.__create_mock_method(method)
         if hasattr(obj, '__dict__') and type(obj.__dict__) is dict:
             obj.__dict__[method] = types.MethodType(meth, obj)
         else:
@@ -140,10 +311,28 @@ class _Flex(object):
 
     def __create_mock_method(self, method):
         def generator_method(yield_values):
-            for value in yield_values:
-                yield value.value
+            for value in _yielded(yield_values):
+                yield value
+
+        def async_method(expectation, yield_values, return_value):
+            from flex import asynchronous
+            latency = expectation._latency
+            if yield_values:
+                return asynchronous._yields(_yielded(yield_values), latency)
+            if return_value.raises:
+                exception = return_value.exception()
+                if expectation._async == ASYNC_GENERATOR:
+                    return asynchronous._yields([], latency, exception)
+                return asynchronous._raises(exception, latency)
+            elif expectation._async == ASYNC_GENERATOR:
+                if return_value.value is None:
+                    # a bare stub still has to be usable with async for
+                    return asynchronous._yields([], latency)
+                return return_value.value
+            return asynchronous._returns(return_value.value, latency)
 
         def pass_thru(expectation, *kargs, **kwargs):
+            __tracebackhide__ = True
             return_values = None
             original_method = expectation.original_method
             mock = expectation.mock
@@ -157,49 +346,90 @@ class _Flex(object):
                 return_values = original_method(*kargs, **kwargs)
             return return_values
 
-        def mock_method(runtime_self, *kargs, **kwargs):
+        def match(kargs, kwargs):
+            __tracebackhide__ = True
             arguments = {'kargs': kargs, 'kwargs': kwargs}
             expectation = self.__get_expectation(method, arguments)
-            if expectation:
-                if not expectation._runnable():
-                    raise StateError(
-                        '%s expected to be called when %s is True' %
-                        (method, _get_runnable_name(expectation._runnable)))
-                expectation._times_called += 1
-                expectation._verify(final=False)
-                _pass_thru = expectation._pass_thru
-                _replace_with = expectation._replace_with
-                if _pass_thru:
-                    return pass_thru(expectation, *kargs, **kwargs)
-                elif _replace_with:
-                    return _replace_with(*kargs, **kwargs)
-                yield_values = expectation._action['yield_values']
-                return_values = expectation._action['return_values']
-                if yield_values:
-                    return generator_method(yield_values)
-                elif return_values:
-                    return_value = return_values[0]
-                    del return_values[0]
-                    return_values.append(return_value)
-                else:
-                    return_value = ReturnValue()
-                if return_value.raises:
-                    if _isclass(return_value.raises):
-                        raise return_value.raises(
-                                *return_value.value['kargs'],
-                                **return_value.value['kwargs'])
-                    else:
-                        raise return_value.raises
-                else:
-                    return return_value.value
-            else:
+            if not expectation:
                 # make sure to clean up expectations to ensure none of them
                 # interfere with the runner's error reporing mechanism
                 # e.g. open()
-                for mock_object, expectations in _flex_objects.items():
-                    for expectation in expectations:
-                        expectation._reset()
-                raise MethodSignatureError(_format_args(method, arguments))
+                self.__context._restore()
+                raise MethodSignatureError(
+                        _Message(_format_args, method, arguments))
+            return expectation
+
+        def respond(expectation, kargs, kwargs):
+            __tracebackhide__ = True
+            if not expectation._runnable():
+                raise StateError(_Message(
+                        _format_state_error, method, expectation._runnable))
+            _pass_thru = expectation._pass_thru
+            _replace_with = expectation._replace_with
+            yield_values = expectation._action['yield_values']
+            return_values = expectation._action['return_values']
+            return_value = None
+            with expectation._lock:
+                expectation._times_called += 1
+                if expectation._transport is not None:
+                    expectation._transport()
+                expectation._verify(final=False)
+                if (return_values and not _pass_thru and
+                        not _replace_with and not yield_values):
+                    return_value = return_values.advance()
+            if expectation._recording is not None:
+                return expectation._recording.play(
+                        method, kargs, kwargs,
+                        lambda: pass_thru(expectation, *kargs, **kwargs))
+            elif _pass_thru:
+                return pass_thru(expectation, *kargs, **kwargs)
+            elif _replace_with:
+                return _replace_with(*kargs, **kwargs)
+            if return_value is None and not yield_values:
+                return_value = ReturnValue()
+            if expectation._async:
+                return async_method(
+                        expectation, yield_values, return_value)
+            if yield_values:
+                return generator_method(yield_values)
+            if return_value.raises:
+                raise return_value.exception()
+            else:
+                return return_value.value
+
+        def specialize():
+            context = self.__context
+            entry = self.__dispatch.get(method)
+            if self not in context.objects or not entry:
+                return _MATCH
+            # the newest expectation wins, if it takes any arguments it's
+            # the only one that can be called
+            expectation = entry['all'][-1]
+            if (expectation._matcher is not None or
+                    expectation._order is not None):
+                return _MATCH
+            return _specialize(expectation, respond, pass_thru)
+
+        state = self.__specialized.setdefault(method, [None])
+
+        def mock_method(runtime_self, *kargs, **kwargs):
+            # hides flex frames from tracebacks shown by pytest
+            __tracebackhide__ = True
+            profiler = profiling._profiler
+            if profiler is not None:
+                return profiler.call(self, method, match, respond,
+                                     kargs, kwargs)
+            handler = state[0]
+            if handler is None:
+                # dropped under the same lock, so a handler built from an
+                # expectation that changes meanwhile isn't kept
+                with self.__context.lock:
+                    handler = state[0]
+                    if handler is None:
+                        handler = state[0] = specialize()
+            if handler is not _MATCH:
+                return handler(kargs, kwargs)
+            return respond(match(kargs, kwargs), kargs, kwargs)
 
         return mock_method
 
@@ -211,9 +441,162 @@ class _Flex(object):
             args = {'kargs': args, 'kwargs': {}}
         if not isinstance(args['kargs'], tuple):
             args['kargs'] = (args['kargs'],)
-        if name and self in _flex_objects:
-            for e in reversed(_flex_objects[self]):
-                if e.method == name and _match_args(args, e.args):
-                    if e._ordered:
-                        e._verify_call_order(_flex_objects)
-                    return e
+        context = self.__context
+        if not name or self not in context.objects:
+            return None
+        entry = self.__dispatch.get(name)
+        if not entry:
+            return None
+        kargs = args['kargs']
+        kwargs = args['kwargs']
+        normalize = entry['all'][0]._normalize
+        if normalize is not None and kwargs:
+            kargs, kwargs = normalize(kargs, kwargs)
+            args = {'kargs': kargs, 'kwargs': kwargs}
+        expectation = self.__lookup(entry, args)
+        if expectation is not None and expectation._order is not None:
+            expectation._verify_call_order(context, kargs, kwargs)
+        return expectation
+
+    def __lookup(self, entry, args):
+        """Finds the expectation a call with args is dispatched to."""
+        expectation = None
+        kargs = args['kargs']
+        kwargs = args['kwargs']
+        key = _literal_key(args)
+        if key is None:
+            # a non-literal argument could compare equal to anything
+            for e in reversed(entry['all']):
+                if e._matcher is None or e._matcher.match(kargs, kwargs):
+                    expectation = e
+                    break
+        else:
+            expectation = entry['literal'].get(key)
+            if expectation is None:
+                seq = -1
+            else:
+                seq = entry['seq'][expectation]
+            # last-defined wins, only check matchers newer than the hit
+            for e in reversed(entry['scan']):
+                if entry['seq'][e] < seq:
+                    break
+                if e._matcher is None or e._matcher.match(kargs, kwargs):
+                    expectation = e
+                    break
+        return expectation
+
+    def __superseded(self, expectation):
+        """Whether calls matching expectation go to a newer one instead."""
+        entry = self.__dispatch.get(expectation.method)
+        if not entry:
+            return False
+        seq = entry['seq'].get(expectation)
+        if seq is None:
+            return True
+        if expectation.args is None:
+            # only another expectation taking any arguments hides this one
+            return any(e._matcher is None for e in entry['all'][seq + 1:])
+        return (self.__lookup(entry, expectation._normalized_args())
+                is not expectation)
+
+
+def _format_state_error(method, runnable):
+    return '%s expected to be called when %s is True' % (
+            method, _get_runnable_name(runnable))
+
+
+# call handler meaning every call has to be matched against the expectations
+_MATCH = object()
+
+
+def _specialize(expectation, respond, pass_thru):
+    """Returns a call handler for the only expectation a method can match.
+
+    Stubs returning a single value, raising a single exception, or passing
+    calls through get a handler doing just that and keeping count. Other
+    expectations only skip the matching. The handler is dropped whenever
+    an expectation of the method changes.
+    """
+    action = expectation._action
+    return_values = action['return_values']
+    lock = expectation._lock
+    checked = [x for x in expectation._expected_calls.values()
+               if x is not None]
+    def responds(kargs, kwargs):
+        __tracebackhide__ = True
+        return respond(expectation, kargs, kwargs)
+    if (expectation._runnable is not _always_runnable or
+            expectation._recording is not None or
+            expectation._transport is not None):
+        return responds
+    if expectation._pass_thru:
+        def passes_thru(kargs, kwargs):
+            __tracebackhide__ = True
+            with lock:
+                expectation._times_called += 1
+                if checked:
+                    expectation._verify(final=False)
+            return pass_thru(expectation, *kargs, **kwargs)
+        return passes_thru
+    if (expectation._async or action['yield_values'] or
+            expectation._replace_with is not None or
+            len(return_values) > 1 or
+            (return_values and return_values.exhaust == RAISE)):
+        return responds
+    if return_values:
+        return_value = return_values[0]
+        # where the cursor ends up after handing out the only value, so
+        # values added later come next as they would otherwise
+        cursor = 1
+    else:
+        return_value = ReturnValue()
+        cursor = 0
+    exception = return_value.raises
+    if isinstance(exception, BaseException):
+        # raised as is, only dropping the traceback of the previous raise
+        def raises(kargs, kwargs):
+            __tracebackhide__ = True
+            with lock:
+                expectation._times_called += 1
+                return_values._cursor = cursor
+                if checked:
+                    expectation._verify(final=False)
+            exception.__traceback__ = None
+            raise exception
+        return raises
+    elif exception:
+        arguments = return_value.value
+        def raises(kargs, kwargs):
+            __tracebackhide__ = True
+            with lock:
+                expectation._times_called += 1
+                return_values._cursor = cursor
+                if checked:
+                    expectation._verify(final=False)
+            raise exception(*arguments['kargs'], **arguments['kwargs'])
+        return raises
+    value = return_value.value
+    def returns(kargs, kwargs):
+        with lock:
+            expectation._times_called += 1
+            return_values._cursor = cursor
+            if checked:
+                expectation._verify(final=False)
+        return value
+    return returns
+
+
+def _get_flex(spec, context=None):
+    """Returns the _Flex for spec in context, creating it if needed."""
+    if context is None:
+        context = _current_context()
+    with context.lock:
+        mock = context.ids.get(id(spec))
+        if mock is None:
+            mock = _Flex(spec, context)
+    return mock
+
+
+def _get_module_flex(name):
+    __import__(name)
+    return _get_flex(sys.modules[name])
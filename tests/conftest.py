@@ -0,0 +1,3 @@
+# verifies flex expectations after each test on pytest versions flex can't
+# hook into on its own
+from flex.pytest_plugin import pytest_runtest_call
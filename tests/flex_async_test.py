@@ -0,0 +1,102 @@
+import asyncio
+import time
+from flex import flex
+from flex.exceptions import FlexError
+import unittest
+
+
+class AsyncService(object):
+    async def fetch(self, key):
+        return 'real %s' % key
+
+    async def stream(self):
+        yield 'real'
+
+    def sync(self):
+        return 'sync'
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def collect(iterator):
+    return [value async for value in iterator]
+
+
+class AsyncClass(object):
+    """Contains features only available in 3.6 and above."""
+
+    def test_flex_should_return_awaitable_for_coroutines(self):
+        service = AsyncService()
+        flex(service).fetch('a').returns('fake')
+        awaitable = service.fetch('a')
+        assert asyncio.iscoroutine(awaitable)
+        awaitable.close()
+        self.assertEqual('fake', run(service.fetch('a')))
+
+    def test_flex_should_raise_on_await_for_coroutines(self):
+        service = AsyncService()
+        flex(service).fetch.raises(KeyError, 'a')
+        awaitable = service.fetch('a')
+        self.assertRaises(KeyError, run, awaitable)
+
+    def test_flex_should_yield_async_iterator(self):
+        service = AsyncService()
+        flex(service).stream.yields(1, 2, 3)
+        self.assertEqual([1, 2, 3], run(collect(service.stream())))
+
+    def test_flex_should_yield_async_iterator_for_coroutines(self):
+        service = AsyncService()
+        flex(service).fetch.yields(1, 2)
+        self.assertEqual([1, 2], run(collect(service.fetch('a'))))
+
+    def test_flex_should_yield_from_source_lazily(self):
+        service = AsyncService()
+        flex(service).stream.yields_from(lambda: iter(range(3)))
+        self.assertEqual([0, 1, 2], run(collect(service.stream())))
+        self.assertEqual([0, 1, 2], run(collect(service.stream())))
+
+    def test_flex_should_yield_nothing_from_bare_async_generator_stubs(self):
+        service = AsyncService()
+        flex(service).stream
+        self.assertEqual([], run(collect(service.stream())))
+
+    def test_flex_should_raise_when_iterating_async_generator(self):
+        service = AsyncService()
+        flex(service).stream.raises(IOError)
+        self.assertRaises(IOError, run, collect(service.stream()))
+
+    def test_flex_should_pass_thru_coroutines(self):
+        service = AsyncService()
+        flex(service).fetch.runs().times(1)
+        self.assertEqual('real a', run(service.fetch('a')))
+
+    def test_latency_runs_stubs_concurrently(self):
+        service = AsyncService()
+        flex(service).fetch.returns('slow').latency(0.1).times(10)
+        async def fetch_all():
+            return await asyncio.gather(
+                    *[service.fetch(i) for i in range(10)])
+        start = time.time()
+        self.assertEqual(['slow'] * 10, run(fetch_all()))
+        assert time.time() - start < 0.5
+
+    def test_latency_allows_testing_timeouts(self):
+        service = AsyncService()
+        flex(service).fetch.returns('slow').latency(10)
+        async def fetch():
+            return await asyncio.wait_for(service.fetch('a'), 0.01)
+        self.assertRaises(asyncio.TimeoutError, run, fetch())
+
+    def test_latency_requires_async_method(self):
+        service = AsyncService()
+        self.assertRaises(FlexError, flex(service).sync.latency, 1)
+
+
+class FlexUnittestAsync(AsyncClass, unittest.TestCase):
+    pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+"""Micro-benchmarks for the flex hot paths.
+
+Run from the tests directory with:
+    python -m flex_bench [--output results.json] [--repeat N]
+
+Results are printed as JSON, each benchmark reporting the best time in
+seconds per operation out of a few repeats so runs can be compared across
+releases.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+if __name__ == '__main__':
+    # run from the tests directory of a checkout, use the flex next to it
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+
+import flex as flex_module
+from flex import fake
+from flex import flex
+from flex import verify
+from flex.helpers import _match_args
+
+
+class Flexed(object):
+    def method(self, arg=None): pass
+
+
+def _best(func, number, repeat):
+    """Returns the best time per call of func over repeat runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_import(number=10, repeat=3):
+    """Time importing flex in a fresh interpreter, without site packages."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(
+            flex_module.__file__)))
+    code = ('import time\n'
+            'start = time.perf_counter()\n'
+            'import flex\n'
+            'print(time.perf_counter() - start)\n')
+    best = None
+    for _ in range(repeat):
+        elapsed = 0
+        for _ in range(number):
+            output = subprocess.check_output(
+                    [sys.executable, '-S', '-c', code], cwd=root)
+            elapsed += float(output)
+        elapsed /= number
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'import': best}
+
+
+def bench_flex_setup(count=10000, repeat=3):
+    """Time flexing count distinct objects, and flexing each one again.
+
+    The mocks are kept referenced in between, as a mock without any stubs
+    is collected as soon as it's discarded and would be created again.
+    """
+    created = found = None
+    for _ in range(repeat):
+        objects = [Flexed() for _ in range(count)]
+        start = time.perf_counter()
+        mocks = [flex(obj) for obj in objects]
+        elapsed = time.perf_counter() - start
+        if created is None or elapsed < created:
+            created = elapsed
+        start = time.perf_counter()
+        for obj in objects:
+            flex(obj)
+        elapsed = time.perf_counter() - start
+        if found is None or elapsed < found:
+            found = elapsed
+        del mocks
+        verify()
+    return {'create': created / count, 'lookup': found / count}
+
+
+def bench_bulk_setup(count=1000, repeat=3):
+    """Time stubbing count methods one at a time, and all at once."""
+    methods = dict(('method_%s' % i, lambda self: None) for i in range(count))
+    Service = type('Service', (object,), methods)
+    stubs = dict((name, i) for i, name in enumerate(methods))
+    def one_by_one():
+        mock = flex(Service())
+        for name, value in stubs.items():
+            getattr(mock, name).returns(value)
+        verify()
+    def bulk():
+        flex(Service(), stubs)
+        verify()
+    return {'one_by_one': _best(one_by_one, 1, repeat),
+            'bulk': _best(bulk, 1, repeat)}
+
+
+def bench_stub_calls(sizes=(1, 10, 100, 1000), number=10000, repeat=3):
+    """Time calls to a stub carrying a varying number of expectations.
+
+    Each stub gets a class matcher followed by size literal expectations.
+    Calls either hit the most recent literal expectation, or fall through
+    to the class matcher.
+    """
+    results = {}
+    for size in sizes:
+        obj = Flexed()
+        mock = flex(obj)
+        mock.method(object).returns('matcher')
+        for i in range(size):
+            mock.method(i).returns(i)
+        last = size - 1
+        results['%s_literal' % size] = _best(
+                lambda: obj.method(last), number, repeat)
+        results['%s_matcher' % size] = _best(
+                lambda: obj.method('miss'), number, repeat)
+        verify()
+    return results
+
+
+def bench_stub_shapes(number=100000, repeat=3):
+    """Time calls to stubs of each shape, called with one argument.
+
+    Stubs without argument constraints get a call handler specialized for
+    their shape, the literal one has to be matched.
+    """
+    shapes = [
+        ('constant', lambda mock: mock.method.returns(1)),
+        ('raises', lambda mock: mock.method.raises(KeyError)),
+        ('raises_instance', lambda mock: mock.method.raises(KeyError('key'))),
+        ('pass_thru', lambda mock: mock.method.runs()),
+        ('cycle', lambda mock: mock.method.returns(1, 2)),
+        ('literal_args', lambda mock: mock.method(1).returns(1)),
+    ]
+    results = {}
+    for name, declare in shapes:
+        obj = Flexed()
+        declare(flex(obj))
+        def call():
+            try:
+                obj.method(1)
+            except KeyError:
+                pass
+        results[name] = _best(call, number, repeat)
+        verify()
+    return results
+
+
+def bench_match_args(number=100000, repeat=3):
+    """Time argument matching against literal, class and regex specs."""
+    given = {'kargs': ('some string', 1), 'kwargs': {'key': 'value'}}
+    specs = {
+        'literal': {'kargs': ('some string', 1), 'kwargs': {'key': 'value'}},
+        'class': {'kargs': (str, int), 'kwargs': {'key': str}},
+        'regex': {'kargs': (re.compile('^some'), int),
+                  'kwargs': {'key': re.compile('val')}},
+    }
+    results = {}
+    for name, spec in specs.items():
+        expectation = flex(Flexed).method(*spec['kargs'], **spec['kwargs'])
+        matcher = expectation._matcher
+        kargs, kwargs = given['kargs'], given['kwargs']
+        results['%s_compiled' % name] = _best(
+                lambda: matcher.match(kargs, kwargs), number, repeat)
+        results['%s_match_args' % name] = _best(
+                lambda: _match_args(given, spec), number, repeat)
+        verify()
+    return results
+
+
+def bench_fake_access(number=100000, repeat=3):
+    """Time attribute access and calls on fakes with each history mode."""
+    results = {}
+    for history in ('all', 1000, 'counts', 'off'):
+        def access():
+            foo.attr
+            foo.method()
+        foo = fake(__history__=history, attr=1, method=lambda: None)
+        results['history_%s' % history] = _best(access, number, repeat)
+    return results
+
+
+def bench_verify(stubs=(1, 10, 100), number=200, repeat=3):
+    """Time verify() tearing down a number of stubbed objects."""
+    results = {}
+    for count in stubs:
+        best = None
+        for _ in range(repeat):
+            elapsed = 0
+            for _ in range(number):
+                for _ in range(count):
+                    flex(Flexed()).method.returns(1).times(0, None)
+                start = time.perf_counter()
+                verify()
+                elapsed += time.perf_counter() - start
+            elapsed /= number
+            if best is None or elapsed < best:
+                best = elapsed
+        results['%s_objects' % count] = best
+    return results
+
+
+BENCHMARKS = [
+    ('import', bench_import),
+    ('flex_setup', bench_flex_setup),
+    ('bulk_setup', bench_bulk_setup),
+    ('stub_calls', bench_stub_calls),
+    ('stub_shapes', bench_stub_shapes),
+    ('match_args', bench_match_args),
+    ('fake_access', bench_fake_access),
+    ('verify', bench_verify),
+]
+
+
+def run(repeat=3, only=None):
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'flex': flex_module.__file__,
+        'unit': 'seconds per operation',
+        'benchmarks': {},
+    }
+    for name, benchmark in BENCHMARKS:
+        if only and name not in only:
+            continue
+        results['benchmarks'][name] = benchmark(repeat=repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs to take the best time of')
+    parser.add_argument('only', nargs='*', help='benchmarks to run')
+    args = parser.parse_args(argv)
+    results = run(args.repeat, args.only)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
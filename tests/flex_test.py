@@ -5,11 +5,18 @@ from flex.exceptions import MethodSignatureError
 from flex.exceptions import StateError
 from flex.exceptions import MethodCallError
 from flex.exceptions import CallOrderError
+from flex.exceptions import ExhaustedError
+from flex.expectation import CYCLE
+from flex.expectation import RAISE
+from flex.expectation import REPEAT_LAST
 from flex.expectation import ReturnValue
 from flex.helpers import _format_args
 from flex import _flex_objects
 from flex import verify
+from flex import context
 from flex import fake
+from flex import stub
+from flex import template
 from flex import flex
 import re
 import sys
@@ -37,6 +44,49 @@ def assertEqual(expected, received, msg=''):
         raise AssertionError('%s != %s : %s' % (expected, received, msg))
 
 
+def _load(value):
+    Loaded.loads += 1
+    return Loaded(value)
+
+
+class Loaded(object):
+    """Counts how many times it gets unpickled."""
+    loads = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        return (_load, (self.value,))
+
+
+class RewritingError(Exception):
+    """Passes a different message on to Exception than it was given."""
+
+    def __init__(self, code):
+        Exception.__init__(self, 'failed with %s' % code)
+        self.code = code
+
+
+class Remote(object):
+    """Used from worker processes, so it has to be importable."""
+
+    def fetch(self, key):
+        return 'real'
+
+    @staticmethod
+    def ping():
+        return 'pong'
+
+
+def _fetch_remotely(key):
+    return Remote().fetch(key), Remote.ping()
+
+
+def _fetch_remotely_many(count):
+    return [Remote().fetch('a') for _ in range(count)][-1]
+
+
 class RegularClass(object):
 
     def test_flex_should_create_mock_object_from_dict(self):
@@ -995,6 +1045,1141 @@ class RegularClass(object):
              {'name': 'hjkl', 'kargs': (), 'kwargs': {}, 'returned': foo}],
             foo.__calls__)
 
+    def test_latest_literal_expectation_wins_over_earlier_matcher(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        flex(foo).method(str).returns('matcher')
+        flex(foo).method('a').returns('literal')
+        assertEqual('literal', foo.method('a'))
+        assertEqual('matcher', foo.method('b'))
+
+    def test_latest_matcher_expectation_wins_over_earlier_literal(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        flex(foo).method('a').returns('literal')
+        flex(foo).method(str).returns('matcher')
+        assertEqual('matcher', foo.method('a'))
+
+    def test_dispatch_handles_many_literal_expectations(self):
+        class Foo:
+            def method(self, arg, kwarg=None): pass
+            def other(self, arg): pass
+        foo = Foo()
+        for i in range(200):
+            flex(foo).method(i, kwarg=str(i)).returns(i)
+            flex(foo).other(i).returns(-i)
+        assertEqual(150, foo.method(150, kwarg='150'))
+        assertEqual(-7, foo.other(7))
+        assertRaises(MethodSignatureError, foo.method, 150, kwarg='151')
+
+    def test_dispatch_matches_unhashable_arguments(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        flex(foo).method([1, 2]).returns('list')
+        flex(foo).method((1, 2)).returns('tuple')
+        assertEqual('list', foo.method([1, 2]))
+        assertEqual('tuple', foo.method((1, 2)))
+
+    def test_flex_returns_distinct_mocks_for_distinct_objects(self):
+        class Foo: pass
+        objects = [Foo() for _ in range(100)]
+        mocks = [flex(obj) for obj in objects]
+        assertEqual(100, len(set(mocks)))
+        assertEqual(mocks, [flex(obj) for obj in objects])
+
+    def test_flex_returns_new_mock_after_teardown(self):
+        class Foo: pass
+        mock = flex(Foo)
+        verify()
+        assert mock is not flex(Foo)
+
+    def test_arg_matching_with_regex_does_not_match_non_strings(self):
+        class Foo:
+            def foo(self, arg): pass
+        foo = Foo()
+        flex(foo).foo(re.compile('1')).returns('mocked')
+        assertEqual('mocked', foo.foo('1'))
+        assertRaises(MethodSignatureError, foo.foo, 1)
+
+    def test_expectation_compiles_arguments_once(self):
+        class Foo:
+            def foo(self, arg, **kwargs): pass
+        expectation = flex(Foo).foo(str, kwarg=re.compile('a'))
+        matcher = expectation._matcher
+        assertEqual(1, len(matcher.kargs))
+        assertEqual(frozenset(['kwarg']), matcher.keys)
+        assert matcher.match(('x',), {'kwarg': 'bab'})
+        assert not matcher.match(('x',), {'kwarg': 'b'})
+        assert not matcher.match(('x',), {'other': 'a'})
+
+    def test_fake_history_can_be_bounded(self):
+        foo = fake(__history__=2, attr=1)
+        for _ in range(10):
+            foo.attr
+        foo.method('arg')
+        assertEqual(2, len(foo.__calls__))
+        assertEqual({'name': 'attr', 'returned': 1}, foo.__calls__[0])
+        assertEqual('method', foo.__calls__[1]['name'])
+        assertEqual(('arg',), foo.__calls__[1]['kargs'])
+
+    def test_fake_history_can_only_count_accesses(self):
+        foo = fake(__history__='counts', method=lambda: 'ok')
+        for _ in range(10):
+            assertEqual('ok', foo.method())
+        foo.other
+        assertEqual([], list(foo.__calls__))
+        assertEqual({'method': 10, 'other': 1}, foo.__counts__)
+
+    def test_fake_history_can_be_turned_off(self):
+        foo = fake(__history__='off', method=lambda: 'ok')
+        foo.method()
+        foo.other()
+        assertEqual([], list(foo.__calls__))
+        assertEqual({}, foo.__counts__)
+
+    def test_recorder_keeps_raised_exceptions(self):
+        def method():
+            raise ValueError
+        foo = fake(method=method)
+        assertRaises(ValueError, foo.method)
+        call = foo.__calls__[0]
+        assertEqual(ValueError, call['raised'][0])
+        assertRaises(KeyError, call.__getitem__, 'returned')
+
+    def test_recorded_calls_can_be_read_like_dicts(self):
+        def method(arg):
+            if arg:
+                raise ValueError
+            return 'ok'
+        foo = fake(method=method)
+        foo.method(0)
+        assertRaises(ValueError, foo.method, 1)
+        returned, raised = foo.__calls__
+        assertEqual((True, False), ('returned' in returned, 'raised' in returned))
+        assertEqual((False, True), ('returned' in raised, 'raised' in raised))
+        assertEqual('ok', returned.get('returned'))
+        assertEqual(None, raised.get('returned'))
+        assertEqual(['name', 'kargs', 'kwargs', 'returned'], returned.keys())
+        assertEqual(returned.keys(), list(returned))
+        assertEqual({'name': 'method', 'kargs': (0,), 'kwargs': {},
+                     'returned': 'ok'}, dict(returned))
+
+    def test_pytest_plugin_verifies_after_each_test(self):
+        import os
+        import shutil
+        import subprocess
+        import tempfile
+        import flex as flex_module
+        if sys.version_info < (3, 4):
+            return
+        import importlib.util
+        if importlib.util.find_spec('pytest') is None:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'test_stubs.py'), 'w') as f:
+                f.write('from flex import flex\n'
+                        'class Foo(object):\n'
+                        '    def method(self): return "real"\n'
+                        'def test_unmet():\n'
+                        '    flex(Foo).method.returns("stub").times(1)\n'
+                        'def test_restored():\n'
+                        '    assert Foo().method() == "real"\n')
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.path.dirname(
+                    os.path.dirname(os.path.abspath(flex_module.__file__)))
+            def run(*options):
+                process = subprocess.Popen(
+                        [sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider']
+                        + list(options) + ['test_stubs.py'], cwd=directory,
+                        env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                return process.communicate()[0].decode('utf-8')
+            output = run('-p', 'flex.pytest_plugin')
+            assert '1 failed, 1 passed' in output, output
+            assert 'MethodCallError' in output, output
+            output = run()
+            assert ("flex can't verify expectations" in output or
+                    '1 failed, 1 passed' in output), output
+        finally:
+            shutil.rmtree(directory)
+
+    def test_import_does_not_import_runners(self):
+        import os
+        import subprocess
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = (
+            'import sys\n'
+            'import flex\n'
+            'print(sorted(set(["doctest", "unittest", "_pytest", "twisted"])'
+            ' & set(sys.modules)))\n')
+        output = subprocess.check_output(
+                [sys.executable, '-S', '-c', code], cwd=root)
+        assertEqual('[]', output.decode('ascii').strip())
+
+    def test_hooks_install_when_runner_is_imported(self):
+        import os
+        import shutil
+        import tempfile
+        import flex as flex_module
+        name = 'flex_test_fake_runner'
+        directory = tempfile.mkdtemp()
+        open(os.path.join(directory, name + '.py'), 'w').close()
+        installed = []
+        flex_module._when_imported(name, lambda: installed.append(name))
+        sys.path.insert(0, directory)
+        try:
+            assertEqual([], installed)
+            __import__(name)
+            assertEqual([name], installed)
+            assert name not in flex_module._pending_hooks
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop(name, None)
+            shutil.rmtree(directory)
+
+    def test_stub_counts_calls_from_many_threads(self):
+        import threading
+        class Client:
+            def get(self, arg): pass
+        client = Client()
+        threads, calls = 16, 2000
+        flex(client).get('url').returns(1, 2, 3, 4).times(threads * calls)
+        results = []
+        def worker():
+            returned = [client.get('url') for _ in range(calls)]
+            results.append(returned)
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        expectation = flex(client)._Flex__get_expectation('get', ('url',))
+        assertEqual(threads * calls, expectation._times_called)
+        returned = [value for values in results for value in values]
+        for value in (1, 2, 3, 4):
+            assertEqual(threads * calls // 4, returned.count(value))
+        verify()
+
+    def test_verify_while_other_threads_flex_objects(self):
+        import threading
+        class Foo:
+            def method(self): pass
+        stop = []
+        def worker():
+            while not stop:
+                flex(Foo()).method.returns(1)
+        workers = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in workers:
+            thread.start()
+        try:
+            for _ in range(200):
+                verify()
+        finally:
+            stop.append(True)
+            for thread in workers:
+                thread.join()
+        verify()
+
+    def test_context_isolates_expectations(self):
+        class Foo:
+            def method(self): return 'real'
+        foo = Foo()
+        outer = flex(foo)
+        with context() as ctx:
+            mock = flex(foo)
+            assert mock is not outer
+            mock.method.returns('inner').times(1)
+            assertEqual('inner', foo.method())
+            assert mock in ctx.objects
+            assert mock not in _flex_objects
+        assertEqual('real', foo.method())
+        assert outer in _flex_objects
+
+    def test_context_verifies_on_exit(self):
+        class Foo:
+            def method(self): pass
+        def run():
+            with context():
+                flex(Foo).method.times(1)
+        assertRaises(MethodCallError, run)
+
+    def test_context_cleans_up_without_verifying_on_error(self):
+        class Foo:
+            def method(self): return 'real'
+        try:
+            with context():
+                flex(Foo).method.returns('fake').times(1)
+                raise ValueError
+        except ValueError:
+            pass
+        assertEqual('real', Foo().method())
+
+    def test_contexts_run_in_parallel_threads(self):
+        import threading
+        errors = []
+        def worker(n):
+            class Foo:
+                def method(self): pass
+            foo = Foo()
+            try:
+                with context():
+                    flex(foo).method.returns(n).times(100)
+                    for _ in range(100):
+                        assertEqual(n, foo.method())
+            except Exception:
+                errors.append(sys.exc_info())
+        workers = [threading.Thread(target=worker, args=(n,))
+                   for n in range(8)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        assertEqual([], errors)
+
+    def test_benchmarks_run(self):
+        import flex_bench
+        results = flex_bench.bench_match_args(number=10, repeat=1)
+        assert results['regex_compiled'] > 0
+        assert flex_bench.bench_stub_calls(sizes=(2,), number=10, repeat=1)
+        assert flex_bench.bench_verify(stubs=(2,), number=2, repeat=1)
+        assert flex_bench.bench_bulk_setup(count=5, repeat=1)
+        assert flex_bench.bench_stub_shapes(number=10, repeat=1)
+
+    def test_teardown_only_tracks_expectations_with_call_counts(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        with context() as ctx:
+            flex(foo).method('a').returns(1)
+            counted = flex(foo).method('b').times(0)
+            ordered = flex(foo).method('c').ordered()
+            assertEqual([counted, ordered], list(ctx.verifiable))
+            assertEqual(1, len(ctx._patched()))
+
+    def test_teardown_restores_method_stubbed_many_times(self):
+        class Foo:
+            def method(self, arg):
+                return 'real'
+        foo = Foo()
+        for i in range(10):
+            flex(foo).method(i).returns(i)
+            flex(Foo).method(i).returns(i)
+        verify()
+        assertEqual('real', foo.method(1))
+        assertEqual('real', Foo().method(1))
+
+    def test_return_values_can_repeat_last_when_exhausted(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        flex(foo).method.returns(1, 2).when_exhausted(REPEAT_LAST)
+        assertEqual([1, 2, 2, 2], [foo.method() for _ in range(4)])
+
+    def test_return_values_can_raise_when_exhausted(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        flex(foo).method.returns(1, 2).when_exhausted(RAISE)
+        assertEqual([1, 2], [foo.method(), foo.method()])
+        assertRaises(ExhaustedError, foo.method)
+
+    def test_return_values_added_after_calls_keep_the_cycle_order(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        expectation = flex(foo).method.returns(1)
+        assertEqual(1, foo.method())
+        expectation.returns(2)
+        assertEqual([1, 2, 1, 2], [foo.method() for _ in range(4)])
+        expectation = flex(foo).method.returns(1, 2, 3)
+        assertEqual([1, 2], [foo.method(), foo.method()])
+        expectation.returns(4)
+        assertEqual([3, 1, 2, 4, 3], [foo.method() for _ in range(5)])
+
+    def test_return_values_replay_large_scripts_in_order(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        values = list(range(10000))
+        flex(foo).method.returns(*values).when_exhausted(CYCLE)
+        assertEqual(values, [foo.method() for _ in values])
+        assertEqual(0, foo.method())
+
+    def test_when_exhausted_rejects_unknown_modes(self):
+        class Foo:
+            def method(self): pass
+        assertRaises(FlexError, flex(Foo).method.returns(1).when_exhausted,
+                     'sometimes')
+
+    def test_records_real_calls_and_replays_them(self):
+        import os
+        import tempfile
+        class Database(object):
+            queries = 0
+            def query(self, sql):
+                Database.queries += 1
+                if sql == 'bad':
+                    raise ValueError('syntax error')
+                return [sql, Database.queries]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            with context():
+                db = Database()
+                flex(db).query.records(path)
+                assertEqual(['select', 1], db.query('select'))
+                assertEqual(['select', 2], db.query('select'))
+                assertRaises(ValueError, db.query, 'bad')
+            assertEqual(3, Database.queries)
+            from flex import cassette
+            cassette._cassettes.clear()
+            with context():
+                db = Database()
+                flex(db).query.records(path).times(4)
+                assertEqual(['select', 1], db.query('select'))
+                assertEqual(['select', 2], db.query('select'))
+                assertEqual(['select', 2], db.query('select'))
+                try:
+                    db.query('bad')
+                    raise AssertionError('ValueError not raised')
+                except ValueError:
+                    assertEqual('syntax error', str(sys.exc_info()[1]))
+            assertEqual(3, Database.queries)
+        finally:
+            os.remove(path)
+
+    def test_cassettes_record_again_once_deleted(self):
+        import os
+        import tempfile
+        from flex import cassette
+        class Database(object):
+            queries = 0
+            def query(self, sql):
+                Database.queries += 1
+                return [sql, Database.queries]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            with context():
+                db = Database()
+                flex(db).query.records(path)
+                assertEqual(['select', 1], db.query('select'))
+            os.remove(path)
+            with context():
+                db = Database()
+                flex(db).query.records(path)
+                assertEqual(['select', 2], db.query('select'))
+                os.remove(path)
+                assertEqual(['other', 3], db.query('other'))
+            assertEqual(1, len(cassette.Cassette(path)._index))
+            cassette._cassettes.clear()
+            with context():
+                db = Database()
+                flex(db).query.records(path)
+                assertEqual(['other', 3], db.query('other'))
+        finally:
+            os.remove(path)
+
+    def test_cassette_keys_are_canonical(self):
+        import os
+        import subprocess
+        import threading
+        from flex import cassette
+        import flex as flex_module
+        text = 'query'
+        copy = ''.join(['que', 'ry'])
+        assertEqual(cassette._call_key('q', (text, text), {}),
+                    cassette._call_key('q', (text, copy), {}))
+        assertEqual(cassette._call_key('q', ({'a': 1, 'b': 2},), {}),
+                    cassette._call_key('q', ({'b': 2, 'a': 1},), {}))
+        assertRaises(FlexError, cassette._call_key,
+                     'q', (threading.Lock(),), {})
+        script = ('from flex import cassette\n'
+                  'print(cassette._call_key("q", (frozenset("abcdef"),), '
+                  '{"tags": {"x", "y", "z"}}))\n')
+        root = os.path.dirname(os.path.dirname(
+                os.path.abspath(flex_module.__file__)))
+        keys = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+            process = subprocess.Popen([sys.executable, '-c', script],
+                                       env=env, stdout=subprocess.PIPE)
+            keys.add(process.communicate()[0])
+        assertEqual(1, len(keys))
+
+    def test_cassettes_record_exceptions_as_raised(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        class Service(object):
+            calls = 0
+            def fail(self, code):
+                Service.calls += 1
+                raise RewritingError(code)
+            def stream(self):
+                Service.calls += 1
+                return (i for i in range(3))
+        try:
+            for _ in range(2):
+                with context():
+                    service = Service()
+                    flex(service).fail.records(path)
+                    try:
+                        service.fail(1)
+                        raise AssertionError('RewritingError not raised')
+                    except RewritingError as e:
+                        assertEqual(('failed with 1', 1), (str(e), e.code))
+            assertEqual(1, Service.calls)
+            with context():
+                service = Service()
+                flex(service).stream.records(path)
+                try:
+                    service.stream()
+                    raise AssertionError('FlexError not raised')
+                except FlexError as e:
+                    assert 'stream returned' in str(e), str(e)
+            assertEqual(2, Service.calls)
+        finally:
+            os.remove(path)
+
+    def test_cassette_only_decodes_replayed_calls(self):
+        import os
+        import tempfile
+        from flex import cassette
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            recorded = cassette.Cassette(path)
+            for i in range(50):
+                key = cassette._call_key('get', (i,), {})
+                recorded.record(key, cassette.RETURNED, Loaded(i))
+            Loaded.loads = 0
+            replayed = cassette.Cassette(path)
+            assertEqual(0, Loaded.loads)
+            key = cassette._call_key('get', (7,), {})
+            kind, value = replayed.outcome(key, 0)
+            assertEqual((cassette.RETURNED, 7), (kind, value.value))
+            assertEqual(1, Loaded.loads)
+            assertEqual(None, replayed.outcome(
+                cassette._call_key('get', (50,), {}), 0))
+        finally:
+            os.remove(path)
+
+    def test_profiling_collects_per_stub_timings(self):
+        import json
+        from flex import profiling
+        class Foo:
+            def method(self, arg): pass
+            def real(self):
+                return 'real'
+        foo = Foo()
+        profiling.enable()
+        try:
+            flex(foo).method('a').returns(1)
+            flex(foo).real.runs()
+            for _ in range(5):
+                foo.method('a')
+            foo.real()
+            assertRaises(MethodSignatureError, foo.method, 'b')
+            verify()
+            report = json.loads(profiling.to_json())
+            stubs = dict((x['stub'], x) for x in report['stubs'])
+            stub = stubs['<Foo instance>.method("a")']
+            assertEqual(5, stub['calls'])
+            assertEqual(5, stub['latency']['count'])
+            assertEqual(0, stub['runs_time'])
+            assert stubs['<Foo instance>.real()']['runs_time'] > 0
+            assertEqual(1, report['unmatched_calls']['count'])
+            assertEqual(1, report['teardown']['count'])
+            assert 'method("a")' in profiling.summary()
+        finally:
+            profiling.disable()
+        assertEqual(None, profiling.summary())
+
+    def test_should_match_numpy_arrays(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        flex(foo).method(numpy.arange(1000)).returns('range')
+        flex(foo).method(numpy.zeros((2, 2))).returns('zeros')
+        flex(foo).method(1).returns('one')
+        assertEqual('range', foo.method(numpy.arange(1000)))
+        assertEqual('zeros', foo.method(numpy.zeros((2, 2))))
+        assertEqual('one', foo.method(1))
+        for arg in (numpy.ones((2, 2)), numpy.zeros(4),
+                    numpy.zeros((2, 2), dtype='int32')):
+            flex(foo).method(numpy.zeros((2, 2)))
+            assertRaises(MethodSignatureError, foo.method, arg)
+
+    def test_should_match_read_only_numpy_arrays_like_array_equal(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        base = numpy.arange(4.0)
+        view = base[:]
+        view.flags.writeable = False
+        flex(foo).method(view).returns('view')
+        base[0] = 9.0
+        given = numpy.array([9.0, 1.0, 2.0, 3.0])
+        given.flags.writeable = False
+        assertEqual('view', foo.method(given))
+        zero = numpy.array([0.0])
+        zero.flags.writeable = False
+        flex(foo).method(zero).returns('zero')
+        negative_zero = numpy.array([-0.0])
+        negative_zero.flags.writeable = False
+        assertEqual('zero', foo.method(negative_zero))
+        nan = numpy.array([numpy.nan])
+        nan.flags.writeable = False
+        flex(foo).method(nan)
+        assertRaises(MethodSignatureError, foo.method, nan.copy())
+
+    def test_should_match_large_buffers(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        payload = b'x' * 1000000
+        flex(foo).method(bytearray(payload)).returns('bytearray')
+        flex(foo).method(payload[:-1] + b'y').returns('other')
+        flex(foo).method(payload).returns('bytes')
+        assertEqual('bytes', foo.method(b'x' * 1000000))
+        assertEqual('bytes', foo.method(bytearray(payload)))
+        assertEqual('bytes', foo.method(memoryview(payload)))
+        assertEqual('other', foo.method(payload[:-1] + b'y'))
+        assertRaises(MethodSignatureError, foo.method, payload[:-1])
+        buffer = bytearray(b'abc')
+        flex(foo).method(buffer).returns('bytearray')
+        assertEqual('bytearray', foo.method(b'abc'))
+        buffer.extend(b'd')
+        assertEqual('bytearray', foo.method(b'abcd'))
+        assertRaises(MethodSignatureError, foo.method, b'abc')
+        flex(foo).method(b'ac').returns('strided')
+        assertEqual('strided', foo.method(memoryview(b'abcd')[::2]))
+        flex(foo).method(memoryview(b'abcd')[::2]).returns('strided')
+        assertEqual('strided', foo.method(b'ac'))
+        verify()
+        buffer.extend(b'e')
+
+    def test_should_match_keyword_and_positional_arguments_alike(self):
+        class Foo:
+            def method(self, a, b=None, *args, **kwargs): pass
+        foo = Foo()
+        flex(foo).method(1, b=2).returns('two')
+        flex(foo).method(1, 3).returns('three')
+        flex(foo).method(a=1, c=4).returns('four')
+        assertEqual('two', foo.method(1, 2))
+        assertEqual('two', foo.method(a=1, b=2))
+        assertEqual('three', foo.method(1, b=3))
+        assertEqual('four', foo.method(1, c=4))
+        flex(foo).method(1, b=2)
+        assertRaises(MethodSignatureError, foo.method, 1, 2, 3)
+
+    def test_should_normalize_arguments_of_inherited_static_methods(self):
+        class Base(object):
+            @staticmethod
+            def static(a, b=0, c=0): pass
+        class Child(Base):
+            pass
+        flex(Child).static(1, c=3).returns('c')
+        assertEqual('c', Child.static(a=1, c=3))
+        assertRaises(MethodSignatureError, Child.static, 1, 3)
+
+    def test_should_normalize_arguments_of_class_and_static_methods(self):
+        class Foo(object):
+            def method(self, a, b): pass
+            @staticmethod
+            def static(a, b): pass
+            @classmethod
+            def klass(cls, a, b): pass
+        flex(Foo).method(1, b=2).returns('method')
+        flex(Foo).static(1, b=2).returns('static')
+        flex(Foo).klass(a=1, b=2).returns('class')
+        assertEqual('method', Foo().method(a=1, b=2))
+        assertEqual('static', Foo.static(1, 2))
+        assertEqual('class', Foo.klass(1, 2))
+
+    def test_should_cache_signatures_per_class_and_method(self):
+        from flex import helpers
+        class Foo(object):
+            def method(self, a): pass
+        flex(Foo()).method(a=1).returns(1)
+        normalizer = helpers._normalizers[Foo]['method']
+        flex(Foo()).method(a=1).returns(1)
+        assert helpers._normalizers[Foo]['method'] is normalizer
+
+    def test_should_leave_arguments_alone_when_they_do_not_bind(self):
+        class Foo:
+            def method(self, a): pass
+        foo = Foo()
+        flex(foo).method(b=1).returns('unbound')
+        flex(foo).method(1).returns('bound')
+        assertEqual('unbound', foo.method(b=1))
+        assertEqual('bound', foo.method(a=1))
+
+    def test_flex_should_stub_many_methods_at_once(self):
+        class Service:
+            def get(self): pass
+            def put(self, value): pass
+            def scan(self): pass
+            def delete(self): pass
+            def __secret(self): pass
+        service = Service()
+        mock = flex(service, {'get': 'value', 'put': stub(None, True)})
+        flex(service, [('scan', stub(yields=[1, 2])),
+                       ('delete', stub(raises=KeyError)),
+                       ('__secret', stub('hidden'))])
+        assert mock is flex(service)
+        assertEqual('value', service.get())
+        assertEqual(None, service.put(1))
+        assertEqual(True, service.put(2))
+        assertEqual([1, 2], list(service.scan()))
+        assertRaises(KeyError, service.delete)
+        assertEqual('hidden', service._Service__secret())
+        mock.get.returns('override')
+        assertEqual('override', service.get())
+        verify()
+        assertEqual(None, service.get())
+
+    def test_flex_stubs_nothing_when_a_method_is_missing(self):
+        class Service:
+            def get(self): pass
+        service = Service()
+        assertRaises(FlexError, flex, service, {'get': 1, 'missing': 2})
+        assertEqual(None, service.get())
+        assertRaises(FlexError, stub, 1, returns=2)
+
+    def test_template_should_be_installed_on_many_objects(self):
+        class Client:
+            def connect(self): pass
+            def query(self, sql, limit=None): pass
+        database = template([
+            ('connect', stub(True, False)),
+            ('query', stub(['row'], args=('SELECT 1',))),
+            ('query', stub(raises=IOError, args=('DROP',), kwargs={'limit': 1})),
+        ])
+        first, second = Client(), Client()
+        flex(first, database)
+        flex(second, database)
+        assertEqual(True, first.connect())
+        assertEqual(True, second.connect())
+        assertEqual(False, first.connect())
+        assertEqual(['row'], first.query(sql='SELECT 1'))
+        assertRaises(IOError, first.query, 'DROP', 1)
+        assertRaises(MethodSignatureError, second.query, 'SELECT 2')
+
+    def test_template_shares_matchers_and_return_values(self):
+        class Client:
+            def query(self, sql): pass
+        database = template({'query': stub(1, 2, args=('SELECT 1',))})
+        first_expectation = _flex_objects[flex(Client(), database)][-1]
+        second_expectation = _flex_objects[flex(Client(), database)][-1]
+        assert first_expectation._matcher is second_expectation._matcher
+        first_values = first_expectation._action['return_values']
+        second_values = second_expectation._action['return_values']
+        assert first_values._values is second_values._values
+        first_expectation.returns(3)
+        assertEqual([1, 2, 3], [v.value for v in first_values])
+        assertEqual([1, 2], [v.value for v in second_values])
+
+    def test_expectations_can_be_pickled(self):
+        import pickle
+        expectation = flex(Remote).fetch('a', key=1).returns('x')
+        copy = pickle.loads(pickle.dumps(expectation))
+        assert copy.mock is flex(Remote)
+        assertEqual('fetch', copy.method)
+        assertEqual({'kargs': ('a',), 'kwargs': {'key': 1}}, copy.args)
+        assertEqual(['x'], [v.value for v in copy._action['return_values']])
+        assertEqual(None, copy._matcher)
+        assertEqual(0, copy._times_called)
+
+    def test_transport_counts_calls_made_by_workers(self):
+        import multiprocessing
+        from flex import transport
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return
+        mp_context = multiprocessing.get_context('fork')
+        flex(Remote).fetch('a').returns('stubbed').times(3)
+        flex(Remote).ping.runs()
+        pool = mp_context.Pool(
+                1, initializer=transport.install,
+                initargs=(transport.export(mp_context),))
+        try:
+            assertEqual([('stubbed', 'pong')] * 3,
+                        pool.map(_fetch_remotely, ['a'] * 3))
+        finally:
+            pool.close()
+            pool.join()
+        verify()
+        flex(Remote).fetch('a').times(1)
+        transport.export(mp_context)
+        assertRaises(MethodCallError, verify)
+
+    def test_transport_doesnt_block_workers_making_many_calls(self):
+        import multiprocessing
+        from flex import transport
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return
+        mp_context = multiprocessing.get_context('fork')
+        flex(Remote).fetch('a').returns('stubbed').times(50000)
+        pool = mp_context.Pool(
+                1, initializer=transport.install,
+                initargs=(transport.export(mp_context),))
+        try:
+            result = pool.apply_async(_fetch_remotely_many, (50000,))
+            assertEqual('stubbed', result.get(timeout=60))
+        finally:
+            pool.close()
+            pool.join()
+        verify()
+
+    def test_shared_counters_count_calls_in_forked_children(self):
+        import multiprocessing
+        from flex import transport
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return
+        mp_context = multiprocessing.get_context('fork')
+        def run_children(count):
+            children = [mp_context.Process(target=_fetch_remotely, args=('a',))
+                        for _ in range(count)]
+            for child in children:
+                child.start()
+            for child in children:
+                child.join()
+        flex(Remote).fetch('a').returns('stubbed').times(3)
+        transport.share(mp_context=mp_context)
+        flex(Remote).ping.returns('pinged').times(2)
+        run_children(2)
+        assertEqual('stubbed', Remote().fetch('a'))
+        verify()
+        flex(Remote).fetch('a').returns('stubbed').times(1)
+        transport.share(mp_context=mp_context)
+        assertEqual('stubbed', Remote().fetch('a'))
+        run_children(1)
+        assertRaises(MethodCallError, verify)
+
+    def test_shared_counters_have_a_capacity(self):
+        from flex import transport
+        class Foo:
+            def method(self): pass
+        flex(Foo).method.returns(1)
+        transport.share(capacity=1)
+        assertRaises(FlexError, getattr, flex(Foo), 'method')
+        verify()
+
+    def test_yields_from_consumes_source_lazily(self):
+        class Foo:
+            def stream(self): pass
+        pulled = []
+        def records():
+            for i in range(10000000):
+                pulled.append(i)
+                yield i
+        foo = Foo()
+        flex(foo).stream.yields_from(records)
+        stream = foo.stream()
+        assertEqual([0, 1, 2], [next(stream) for _ in range(3)])
+        assertEqual(3, len(pulled))
+        assertEqual(0, next(foo.stream()))
+        flex(foo).stream.yields_from(range(3))
+        assertEqual([0, 1, 2], list(foo.stream()))
+        assertEqual([0, 1, 2], list(foo.stream()))
+
+    def test_yields_from_can_share_a_cursor_between_calls(self):
+        class Foo:
+            def stream(self): pass
+        foo = Foo()
+        flex(foo).stream.yields_from(iter(range(5)), shared=True)
+        first = foo.stream()
+        assertEqual([0, 1], [next(first), next(first)])
+        assertEqual([2, 3, 4], list(foo.stream()))
+        assertEqual([], list(first))
+
+    def test_yields_from_stubs_can_be_exported(self):
+        import pickle
+        from flex import transport
+        with context():
+            flex(Remote).fetch.yields_from(range(3))
+            flex(Remote).ping.yields_from([0, 1, 2], shared=True)
+            ping = Remote.ping()
+            assertEqual([0, 1], [next(ping), next(ping)])
+            expectations = pickle.loads(
+                    pickle.dumps(transport.export().expectations))
+            assertEqual([[0, 1, 2], [0, 1, 2]],
+                        [list(e._action['yield_values']) for e in expectations])
+
+    def test_yields_from_rejects_iterators_unless_shared(self):
+        class Foo:
+            def stream(self): pass
+        assertRaises(FlexError, flex(Foo).stream.yields_from, iter([1]))
+        assertRaises(FlexError, flex(Foo).stream.yields(1).yields_from, [2])
+        assertRaises(FlexError, flex(Foo).stream.yields_from([2]).yields, 1)
+
+    def test_flexed_objects_can_be_garbage_collected(self):
+        import gc
+        import weakref
+        class Foo(object):
+            def method(self): pass
+        foo = Foo()
+        ref = weakref.ref(foo)
+        flex(foo).method.returns(1)
+        mock = flex(foo)
+        assert mock in _flex_objects
+        del foo, mock
+        gc.collect()
+        assertEqual(None, ref())
+        assertEqual(0, len([m for m in _flex_objects
+                            if m._Flex__object.__class__ is Foo]))
+
+    def test_objects_with_call_counts_are_kept_until_verified(self):
+        import gc
+        import weakref
+        class Foo(object):
+            def method(self): pass
+        foo = Foo()
+        ref = weakref.ref(foo)
+        flex(foo).method.times(1)
+        del foo
+        gc.collect()
+        assert ref() is not None
+        assertRaises(MethodCallError, verify)
+        gc.collect()
+        assertEqual(None, ref())
+
+    def test_leak_report_lists_objects_still_held(self):
+        from flex import leaks
+        class Leaky(object):
+            def method(self): pass
+        leaky = Leaky()
+        leaky.payload = 'x' * 100000
+        with context():
+            flex(leaky).method.returns(1)
+            entry = [x for x in leaks.pinned()
+                     if x['object'] == '<Leaky instance>'][0]
+            assertEqual(['method'], entry['methods'])
+            assert entry['retained'] > 100000
+            assert '<Leaky instance>' in leaks.report()
+        assertEqual([], [x for x in leaks.pinned()
+                         if x['object'] == '<Leaky instance>'])
+
+    def test_ordered_expectations_span_objects(self):
+        class Connection:
+            def open(self): pass
+            def close(self): pass
+        class Query:
+            def run(self): pass
+        connection, query = Connection(), Query()
+        with context() as ctx:
+            flex(connection).open.ordered()
+            flex(query).run.ordered()
+            assertRaises(CallOrderError, query.run)
+            ctx._teardown()
+        flex(connection).open.ordered()
+        flex(query).run.ordered()
+        flex(connection).close.ordered()
+        connection.open()
+        query.run()
+        query.run()
+        connection.close()
+        connection.open()
+
+    def test_ordered_expectations_matching_the_call_can_be_skipped(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        with context():
+            flex(foo).method(int).returns('any int').ordered()
+            flex(foo).method(1).returns('one').ordered()
+            assertEqual(('one', 'any int'), (foo.method(1), foo.method(2)))
+
+    def test_skipped_ordered_expectations_are_examined_once(self):
+        from flex.expectation import Expectation
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        lookups = []
+        superseded = Expectation._superseded
+        def count(expectation):
+            lookups.append(expectation)
+            return superseded(expectation)
+        Expectation._superseded = count
+        try:
+            with context() as ctx:
+                flex(foo).method(int).ordered()
+                for i in range(1000):
+                    flex(foo).method(i).ordered()
+                for i in range(1000):
+                    foo.method(i)
+                assertEqual(1000, ctx.order_cursor)
+        finally:
+            Expectation._superseded = superseded
+        assertEqual(1, len(lookups))
+
+    def test_superseded_ordered_expectations_dont_hold_back_calls(self):
+        class Foo:
+            def method(self, arg): pass
+            def other(self): pass
+        foo = Foo()
+        with context() as ctx:
+            flex(foo).method('a').ordered()
+            flex(foo).method('a').returns('again').ordered()
+            flex(foo).other.returns('other').ordered()
+            assertEqual('again', foo.method('a'))
+            assertEqual('other', foo.other())
+            flex(foo).method('b').ordered()
+            flex(foo).other.ordered()
+            assertRaises(CallOrderError, foo.other)
+            ctx._teardown()
+
+    def test_ordered_expectations_are_checked_with_a_cursor(self):
+        class Foo:
+            def method(self, arg): pass
+        foo = Foo()
+        with context() as ctx:
+            for i in range(100):
+                flex(foo).method(i).ordered()
+            for i in range(50):
+                foo.method(i)
+            assertEqual(49, ctx.order_cursor)
+            assertRaises(CallOrderError, foo.method, 99)
+            assertEqual(50, ctx.order_cursor)
+            ctx._teardown()
+
+    def test_specialized_stubs_follow_expectation_changes(self):
+        class Foo:
+            def method(self, arg=None): return 'real'
+        foo = Foo()
+        expectation = flex(foo).method.returns(1)
+        assertEqual(1, foo.method())
+        assertEqual(1, foo.method('any'))
+        expectation.returns(2)
+        assertEqual(1, foo.method())
+        assertEqual(2, foo.method())
+        flex(foo).method.raises(KeyError, 'missing')
+        assertRaises(KeyError, foo.method)
+        flex(foo).method('a').returns('a')
+        assertEqual('a', foo.method('a'))
+        assertRaises(KeyError, foo.method, 'b')
+        flex(foo).method.runs().times(1)
+        assertEqual('real', foo.method())
+        assertRaises(MethodCallError, foo.method)
+        verify()
+        assertEqual('real', foo.method())
+
+    def test_specialized_stubs_follow_changes_from_other_threads(self):
+        import threading
+        from flex import wrap
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        expectation = flex(foo).method.returns(1)
+        building = threading.Event()
+        changed = threading.Event()
+        original = wrap._specialize
+        def specialize(*kargs):
+            handler = original(*kargs)
+            if threading.current_thread() is caller:
+                building.set()
+                changed.wait(5)
+            return handler
+        caller = threading.Thread(target=foo.method)
+        changer = threading.Thread(target=expectation.returns, args=(2,))
+        wrap._specialize = specialize
+        try:
+            caller.start()
+            building.wait(5)
+            changer.start()
+            changer.join(0.1)
+            changed.set()
+            caller.join()
+            changer.join()
+        finally:
+            wrap._specialize = original
+        assertEqual([2, 1], [foo.method(), foo.method()])
+        verify()
+
+    def test_specialized_stubs_keep_count(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        flex(foo).method.returns(1).times(3)
+        for _ in range(3):
+            foo.method()
+        verify()
+        flex(foo).method.raises(ValueError).times(2)
+        assertRaises(ValueError, foo.method)
+        assertRaises(MethodCallError, verify)
+
+    def test_raised_instances_dont_grow_tracebacks(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        error = KeyError('key')
+        flex(foo).method.raises(error)
+        depths = []
+        for _ in range(3):
+            try:
+                foo.method()
+            except KeyError as e:
+                assertEqual(error, e)
+                depth, tb = 0, e.__traceback__
+                while tb:
+                    depth, tb = depth + 1, tb.tb_next
+                depths.append(depth)
+        assertEqual(1, len(set(depths)))
+
+    def test_raises_accepts_exception_factories(self):
+        class Foo:
+            def method(self): pass
+        foo = Foo()
+        made = []
+        def factory(*kargs):
+            made.append(kargs)
+            return KeyError(*kargs)
+        flex(foo).method.raises(factory, 'key')
+        assertRaises(KeyError, foo.method)
+        assertRaises(KeyError, foo.method)
+        assertEqual([('key',), ('key',)], made)
+
+    def test_error_messages_are_formatted_when_shown(self):
+        class Foo(object):
+            def method(self, arg): pass
+        foo = Foo()
+        flex(foo).method('a')
+        try:
+            foo.method('b')
+        except MethodSignatureError as e:
+            assertEqual(str, type(e.args[0]))
+            assertEqual(e.args[0], str(e))
+            assertEqual(True, 'method("b")' in e.args[0])
+        flex(foo).method('a').ordered()
+        flex(foo).method('b').ordered()
+        try:
+            foo.method('b')
+        except CallOrderError as e:
+            assertEqual('method("b") called before method("a")', str(e))
+        flex(foo).method('c').when(lambda: False)
+        try:
+            foo.method('c')
+        except StateError as e:
+            assertEqual(True, 'expected to be called when' in str(e))
+        verify()
+
 
 class TestFlexUnittest(RegularClass, unittest.TestCase):
     def tearDown(self):
@@ -1011,5 +2196,12 @@ if sys.version_info >= (2, 6):
         pass
 
 
+if sys.version_info >= (3, 7):
+    import flex_async_test
+
+    class TestUnittestAsync(flex_async_test.FlexUnittestAsync):
+        pass
+
+
 if __name__ == '__main__':
     unittest.main()